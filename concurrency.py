@@ -145,6 +145,9 @@ dish_queue.join()  # see below (note that dish_queue is its own process)
 # control access to a common resource by multiple processes in a concurrent
 # system such as a multiprogramming operating system.)
 
+# See concurrency_pipeline.py for a version of this with any number of dryers,
+# dishes sent in batches and a clean way to stop the dryers.
+
 
 # Daemon Processes
 # -----------------------------------------------------------------------------
@@ -472,6 +475,11 @@ for num in range(DRYERS):
 
 # don't forget to shutdown the server: redis-cli shutdown
 
+# See demos/redis_batch_washer.py and demos/redis_batch_dryer.py for versions
+# that move dishes in batches rather than one round trip per dish. If you
+# don't have Redis installed, demos/fake_redis.py is a small stand-in server
+# that's enough to try these examples.
+
 
 # Final Note on Queues
 # -----------------------------------------------------------------------------
@@ -492,7 +500,9 @@ for num in range(DRYERS):
 # is done, it's removed from the working list and added to the completed list.
 # This lets you know what tasks have failed or are taking too long. You can do
 # this kind of thing with Redis yourself or use a system that someone else has
-# already written and tested (some of which use Redis):
+# already written and tested (some of which use Redis). The working-list
+# idea is in demos/redis_reliable_queue.py, along with a supervisor that
+# starts and stops dryers to keep up with the backlog:
 
 # http://python-rq.org/
 # http://www.celeryproject.org/
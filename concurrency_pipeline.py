@@ -0,0 +1,1019 @@
+'''Concurrency: a washer/dryer pipeline'''
+
+
+# The multiprocessing washer/dryer example in concurrency.py has one dryer
+# process taking one dish at a time off a JoinableQueue. That's fine for five
+# dishes, but it doesn't scale:
+
+# – there's only ever one dryer, however many CPUs there are or however
+#   long each dish takes,
+# – every dish is pickled, written to a pipe by the queue's feeder thread,
+#   read and unpickled on its own, which costs far more than drying a
+#   simple dish,
+# – the dryer never finishes; the program just kills it on the way out
+#   because it's a daemon process.
+
+# Stage below is one step of a pipeline, run by N worker processes:
+
+# – items go through the queues in micro-batches (lists of batch_size items)
+#   so the pickling and pipe overhead is paid once per batch rather than
+#   once per item,
+# – results come back in the order the items went in (ordered=True) or as
+#   soon as each batch is done (ordered=False),
+# – when there are no more items, one sentinel (None) per worker tells each
+#   worker to finish up and exit, so nothing is killed part way through a
+#   dish,
+# – the queues can have a size limit, so a fast washer can't pile up
+#   dishes without end, and each stage keeps metrics that show which stage
+#   is holding the others up.
+
+# RingQueue is for when the items are small fixed-size records: a queue in
+# shared memory that the washer/dryer code can use in place of a
+# JoinableQueue without pickling anything.
+
+# AsyncStage is Stage for asyncio, for dryers that spend their time waiting
+# on I/O rather than computing.
+
+# NOTE: the worker processes are started by multiprocessing, so anything
+# that runs code at the top level is kept under if __name__ == '__main__'
+# (with the 'spawn' start method, the default on Windows and macOS, every
+# worker imports this file).
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import asyncio
+import collections
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+
+# Stage
+# -----------------------------------------------------------------------------
+# The func a Stage runs has to be picklable, i.e. a function defined at the
+# top level of a module (not a lambda or a function inside a function).
+
+# A worker takes a batch off inbox, runs func on every item in it and puts
+# (batch number, results, seconds spent in func) on outbox. If func raises,
+# the exception is sent back instead of the results and re-raised in the
+# main process by results(). When a worker gets the sentinel, it passes it
+# on to outbox so results() can tell when every worker has finished.
+
+def _worker(func, inbox, outbox):
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            outbox.put(None)
+            break
+        number, items = batch
+        start = time.perf_counter()
+        try:
+            results = [func(item) for item in items]
+        except Exception as e:
+            outbox.put((number, e, time.perf_counter() - start))
+        else:
+            outbox.put((number, results, time.perf_counter() - start))
+
+
+# Back pressure
+# -------------
+# With the default maxsize=0 the queues have no limit: if the washer is
+# faster than the dryers, the dishes pile up in the queue (in memory) for as
+# long as the washer keeps going. With maxsize set, each queue holds at most
+# that many batches, and when the inbox is full policy decides what happens:
+
+# – 'block': put() waits until the workers have made room. The washer slows
+#   down to the dryers' pace (back pressure, see concurrency.py).
+# – 'drop': the batch is thrown away and counted in dropped. For things
+#   where the latest value is all that matters, like sensor readings.
+
+# The outbox has the same limit, so if nobody reads the results the workers
+# wait too. That means a Stage with maxsize has to be fed and read at the
+# same time, which is what map() does.
+
+# Metrics
+# -------
+# stats() returns a snapshot of how the stage is doing:
+
+# depth            items put in but not back out yet (queued or being worked)
+# items            items finished
+# dropped          items thrown away by the 'drop' policy
+# items_per_sec    items finished per second since start() (until the
+#                  last worker finished)
+# latency_p50/90/99  seconds from put() to the result coming back, for the
+#                  last 1000 batches (every item in a batch has the same)
+# busy             the share of the workers' time spent in func. Close to 1
+#                  means the workers never wait for work: this stage is the
+#                  bottleneck and more workers would help. Low means the
+#                  stage is waiting on whatever feeds it.
+
+# If hook is given, results() calls hook(stats()) every interval seconds
+# and once more at the end. report() is a hook that prints one line.
+
+class Stage():
+
+    def __init__(self, func, workers=2, batch_size=100, ordered=True,
+                 maxsize=0, policy='block', name=None, hook=None,
+                 interval=1.0):
+        if policy not in ('block', 'drop'):
+            raise ValueError("policy must be 'block' or 'drop'")
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.policy = policy
+        self.name = name or func.__name__
+        self.hook = hook
+        self.interval = interval
+        self.inbox = mp.Queue(maxsize)
+        self.outbox = mp.Queue(maxsize)
+        self.items = 0
+        self.dropped = 0
+        self._batch = []
+        self._next = 0      # the next batch number
+        self._sent = 0      # items put on inbox
+        self._sent_at = {}  # batch number -> time it was put on inbox
+        self._latencies = collections.deque(maxlen=1000)
+        self._work = 0.0    # seconds the workers have spent in func
+        self._started = None
+        self._finished = None
+        self._reported = None
+        self._processes = []
+        self._running = 0   # workers that haven't sent their sentinel back
+        self._pending = {}  # batches that came back before their turn
+        self._wanted = 0    # the next batch number to hand back (ordered)
+        self._closed = False
+
+    def start(self):
+        for _ in range(self.workers):
+            process = mp.Process(target=_worker,
+                                 args=(self.func, self.inbox, self.outbox))
+            process.start()
+            self._processes.append(process)
+        self._running = self.workers
+        self._started = self._reported = time.perf_counter()
+        return self
+
+    def put(self, item):
+        if self._closed:
+            raise ValueError('put() on a closed Stage')
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # send a partly full batch now rather than wait for it to fill up
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        # a dropped batch doesn't use up a number, so ordered results don't
+        # end up waiting for it
+        number = self._next
+        self._sent_at[number] = time.perf_counter()
+        try:
+            self.inbox.put((number, batch), block=self.policy == 'block')
+        except queue.Full:
+            del self._sent_at[number]
+            self.dropped += len(batch)
+        else:
+            self._next += 1
+            self._sent += len(batch)
+
+    def close(self):
+        # no more items: send what's left and a sentinel for each worker
+        if not self._closed:
+            if self._batch:
+                self.flush()
+            for _ in self._processes:
+                self.inbox.put(None)
+            self._closed = True
+
+    def results(self):
+        # Generator of func(item) for every item put(), until close() has
+        # been called and every worker has finished. Then the worker
+        # processes are joined.
+        while self._running:
+            message = self.outbox.get()
+            if message is None:
+                self._running -= 1
+                continue
+            number, results, work = message
+            if isinstance(results, Exception):
+                self.terminate()
+                raise results
+            now = time.perf_counter()
+            self._latencies.append(now - self._sent_at.pop(number, now))
+            self._work += work
+            self.items += len(results)
+            if self.hook and now - self._reported >= self.interval:
+                self._reported = now
+                self.hook(self.stats())
+            if not self.ordered:
+                yield from results
+                continue
+            self._pending[number] = results
+            while self._wanted in self._pending:
+                yield from self._pending.pop(self._wanted)
+                self._wanted += 1
+        self.join()
+        if self._finished is None:
+            self._finished = time.perf_counter()
+        if self.hook:
+            self.hook(self.stats())
+
+    def map(self, items):
+        # put() every item from a separate thread while the results are read
+        # here, then close(). Reading and writing at the same time means
+        # neither side can end up waiting on the other. items can be another
+        # stage's map(), which makes a pipeline:
+        # dryers.map(washers.map(dishes))
+        errors = []
+
+        def feed():
+            try:
+                for item in items:
+                    self.put(item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.close()
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        yield from self.results()
+        feeder.join()
+        if errors:
+            raise errors[0]
+
+    def stats(self):
+        elapsed = (self._finished or time.perf_counter()) - self._started
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {'stage': self.name,
+                'workers': self.workers,
+                'depth': self._sent + len(self._batch) - self.items,
+                'items': self.items,
+                'dropped': self.dropped,
+                'items_per_sec': self.items / elapsed if elapsed else 0.0,
+                'latency_p50': percentile(0.5),
+                'latency_p90': percentile(0.9),
+                'latency_p99': percentile(0.99),
+                'busy': self._work / (elapsed * self.workers)
+                        if elapsed else 0.0}
+
+    def join(self):
+        for process in self._processes:
+            process.join()
+
+    def terminate(self):
+        # for emergencies only: workers are stopped wherever they are
+        for process in self._processes:
+            process.terminate()
+        self.join()
+        self._running = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+            for _ in self.results():  # wait for the workers to finish
+                pass
+        else:
+            self.terminate()
+
+
+def report(stats):
+    print('{stage} x{workers}: {items} done, {dropped} dropped, '
+          '{items_per_sec:.0f}/sec, depth {depth}, busy {busy:.0%}'.format(
+              **stats))
+    print('    latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+        stats['latency_p50'] * 1000, stats['latency_p90'] * 1000,
+        stats['latency_p99'] * 1000))
+
+
+# Shared memory ring buffer
+# -----------------------------------------------------------------------------
+# Every item put on a multiprocessing queue is pickled, handed to a feeder
+# thread, written to a pipe, read back out of the pipe by the other process
+# and unpickled. When every item is the same fixed-size record (a few
+# numbers, a short name) most of that work isn't needed.
+
+# RingQueue keeps the items in a block of shared memory
+# (multiprocessing.shared_memory, python 3.8+) that every process maps. Each
+# item is packed into a slot with struct, e.g. record='d' is one float and
+# record='10sd' is 10 bytes and a float (see binary_and_unicode.py for struct
+# formats). The slots are used in a circle: put() writes at tail, get() reads
+# at head, and both wrap around to the start at the end of the buffer.
+
+# – Two semaphores count the filled and the empty slots, so get() waits
+#   while the buffer is empty and put() waits while it's full.
+# – One lock protects head and tail (kept in the shared memory too), so any
+#   number of processes can put and get at the same time (MPMC).
+# – It has the same put() / get() / task_done() / join() as JoinableQueue:
+#   the count of unfinished items is in the shared memory, and a Condition
+#   on the same lock wakes join() when it gets to 0.
+
+# Strings have to be bytes for struct, and shorter ones come back padded
+# with b'\0'. Longer ones struct would quietly cut short, so put() raises
+# ValueError for those instead. A record with one field is put and got as a
+# plain value rather than a 1-tuple.
+
+# The process that creates the RingQueue owns the shared memory and should
+# call close() when everyone's done with it, which also unlinks (deletes) it.
+# Other processes get a copy of the RingQueue when it's passed to
+# mp.Process, the same as with mp.Queue. With fork (the default on Linux)
+# that copy is never pickled, so the owner is the process id that made the
+# queue rather than a flag; in any other process close() only closes that
+# process's own mapping.
+
+_HEADER = struct.Struct('QQQ')  # head, tail, unfinished tasks
+_HEADER_SIZE = 64               # the slots start on their own cache line
+_FIELD = re.compile(r'(\d*)([xcbB?hHiIlLqQnNefdspP])')
+
+
+def _string_fields(record):
+    # [(index of the value, most bytes it can hold), ...] for each s or p
+    # field in a struct format, e.g. '10sd' -> [(0, 10)]
+    fields = []
+    index = 0
+    for count, code in _FIELD.findall(record):
+        count = int(count) if count else 1
+        if code in 'sp':
+            fields.append((index, count if code == 's' else count - 1))
+            index += 1
+        elif code != 'x':
+            index += count
+    return fields
+
+
+class RingQueue():
+
+    def __init__(self, slots=1024, record='d'):
+        self.slots = slots
+        self.record = record
+        self._struct = struct.Struct(record)
+        size = _HEADER_SIZE + slots * self._struct.size
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        _HEADER.pack_into(self._shm.buf, 0, 0, 0, 0)
+        self._owner = os.getpid()
+        self._strings = _string_fields(record)
+        self._lock = mp.Lock()
+        self._cond = mp.Condition(self._lock)
+        self._items = mp.Semaphore(0)
+        self._spaces = mp.Semaphore(slots)
+
+    def __getstate__(self):
+        # struct.Struct can't be pickled, so the copy makes its own
+        state = self.__dict__.copy()
+        del state['_struct']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._struct = struct.Struct(self.record)
+
+    def _offset(self, position):
+        return _HEADER_SIZE + (position % self.slots) * self._struct.size
+
+    def put(self, item, block=True, timeout=None):
+        if not isinstance(item, tuple):
+            item = (item,)
+        for index, size in self._strings:
+            value = item[index] if index < len(item) else None
+            if isinstance(value, bytes) and len(value) > size:
+                raise ValueError('{} bytes is too long for a {} byte field '
+                                 'of {!r}'.format(len(value), size,
+                                                  self.record))
+        if not self._spaces.acquire(block, timeout):
+            raise queue.Full
+        buf = self._shm.buf
+        try:
+            with self._lock:
+                head, tail, unfinished = _HEADER.unpack_from(buf)
+                self._struct.pack_into(buf, self._offset(tail), *item)
+                _HEADER.pack_into(buf, 0, head, tail + 1, unfinished + 1)
+        except struct.error:
+            self._spaces.release()  # the item didn't fit the record
+            raise
+        self._items.release()
+
+    def get(self, block=True, timeout=None):
+        if not self._items.acquire(block, timeout):
+            raise queue.Empty
+        buf = self._shm.buf
+        with self._lock:
+            head, tail, unfinished = _HEADER.unpack_from(buf)
+            item = self._struct.unpack_from(buf, self._offset(head))
+            _HEADER.pack_into(buf, 0, head + 1, tail, unfinished)
+        self._spaces.release()
+        return item[0] if len(item) == 1 else item
+
+    def task_done(self):
+        buf = self._shm.buf
+        with self._cond:
+            head, tail, unfinished = _HEADER.unpack_from(buf)
+            if not unfinished:
+                raise ValueError('task_done() called too many times')
+            _HEADER.pack_into(buf, 0, head, tail, unfinished - 1)
+            if unfinished == 1:
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not _HEADER.unpack_from(self._shm.buf)[2])
+
+    def qsize(self):
+        with self._lock:
+            head, tail, unfinished = _HEADER.unpack_from(self._shm.buf)
+        return tail - head
+
+    def empty(self):
+        return not self.qsize()
+
+    def full(self):
+        return self.qsize() >= self.slots
+
+    def close(self):
+        self._shm.close()
+        if self._owner == os.getpid():
+            self._shm.unlink()
+
+
+# asyncio
+# -----------------------------------------------------------------------------
+# When drying a dish mostly means waiting (on the network, a database, a
+# disk) rather than computing, a process per dryer is a heavy way to wait:
+# each one is a whole python interpreter, takes a while to start and needs
+# everything pickled to talk to it. With asyncio (see concurrency.py) the
+# dryers are tasks in one thread, and one task waiting lets the others run.
+
+# AsyncStage is the same idea as Stage with an asyncio.Queue in between:
+
+# – func is a coroutine function (async def) and workers tasks run it, so
+#   up to workers dishes are being waited on at a time,
+# – put() / join() work like JoinableQueue's: every item taken off the queue
+#   is marked done (task_done()) once its result has been passed on, and
+#   join() waits until everything put so far has been done,
+# – results() and map() are async generators that work like Stage's,
+# – maxsize limits both queues and put() waits for room (back pressure).
+#   There are no batches since nothing is pickled.
+
+# Shutting down: close() puts one sentinel per worker and each worker
+# finishes the dish in hand before it exits. If the code using the stage is
+# cancelled (or raises), __aexit__ cancels the workers instead and waits for
+# them to actually stop, so no task is left running in the background. A
+# worker cancelled part way through a dish still marks it done in a
+# finally block, so join() can't be left waiting for it.
+
+class AsyncStage():
+
+    def __init__(self, func, workers=2, ordered=True, maxsize=0):
+        self.func = func
+        self.workers = workers
+        self.ordered = ordered
+        self.maxsize = maxsize
+        self._tasks = []
+        self._next = 0
+        self._running = 0
+        self._pending = {}
+        self._wanted = 0
+        self._closed = False
+
+    async def start(self):
+        # queues are made here, inside the running event loop
+        self.inbox = asyncio.Queue(self.maxsize)
+        self.outbox = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker())
+                       for _ in range(self.workers)]
+        self._running = self.workers
+        return self
+
+    async def _worker(self):
+        while True:
+            message = await self.inbox.get()
+            try:
+                if message is None:
+                    await self.outbox.put(None)
+                    return
+                number, item = message
+                try:
+                    result = await self.func(item)
+                except Exception as e:
+                    result = e
+                await self.outbox.put((number, result))
+            finally:
+                self.inbox.task_done()
+
+    async def put(self, item):
+        if self._closed:
+            raise ValueError('put() on a closed AsyncStage')
+        await self.inbox.put((self._next, item))
+        self._next += 1
+
+    async def join(self):
+        await self.inbox.join()
+
+    async def close(self):
+        if not self._closed:
+            self._closed = True
+            for _ in self._tasks:
+                await self.inbox.put(None)
+
+    async def results(self):
+        while self._running:
+            message = await self.outbox.get()
+            if message is None:
+                self._running -= 1
+                continue
+            number, result = message
+            if isinstance(result, Exception):
+                await self.cancel()
+                raise result
+            if not self.ordered:
+                yield result
+                continue
+            self._pending[number] = result
+            while self._wanted in self._pending:
+                yield self._pending.pop(self._wanted)
+                self._wanted += 1
+        await asyncio.gather(*self._tasks)
+
+    async def map(self, items):
+        # items is an iterable or an async iterable (e.g. another stage's
+        # map()), fed in by a separate task while the results come out here
+        async def feed():
+            try:
+                if hasattr(items, '__aiter__'):
+                    async for item in items:
+                        await self.put(item)
+                else:
+                    for item in items:
+                        await self.put(item)
+            finally:
+                await self.close()
+
+        feeder = asyncio.create_task(feed())
+        try:
+            async for result in self.results():
+                yield result
+            await feeder
+        finally:
+            if not feeder.done():
+                feeder.cancel()
+                await asyncio.gather(feeder, return_exceptions=True)
+
+    async def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._running = 0
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, *exc):
+        if exc_type is None:
+            await self.close()
+            async for _ in self.results():
+                pass
+        else:
+            await self.cancel()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The washer/dryer example again, with three dryers. The washer is the main
+# program, putting each dish into the stage; the dried dishes come back in
+# the order they were washed.
+
+def dry(dish):
+    time.sleep(0.1)
+    return 'dried {} dish'.format(dish)
+
+
+if __name__ == '__main__':
+    dishes = ['salad', 'bread', 'main', 'side', 'dessert']
+    with Stage(dry, workers=3, batch_size=1) as dryers:
+        for dish in dishes:
+            print('washing', dish, 'dish')
+            dryers.put(dish)
+        dryers.close()
+        for result in dryers.results():
+            print(result)
+
+# washing salad dish
+# washing bread dish
+# washing main dish
+# washing side dish
+# washing dessert dish
+# dried salad dish
+# dried bread dish
+# dried main dish
+# dried side dish
+# dried dessert dish
+
+# And the original concurrency.py example with a RingQueue in place of the
+# JoinableQueue. Dish names are sent as bytes, at most 10 of them. Instead of
+# being a daemon, the dryer stops when it gets the 'quit' sentinel.
+
+def ring_dryer(queue):
+    while True:
+        dish = queue.get().rstrip(b'\0').decode('utf-8')
+        queue.task_done()
+        if dish == 'quit':
+            break
+        print('drying', dish, 'dish')
+
+
+if __name__ == '__main__':
+    dish_queue = RingQueue(slots=4, record='10s')
+    dryer_process = mp.Process(target=ring_dryer, args=(dish_queue,))
+    dryer_process.start()
+    for dish in ['salad', 'bread', 'main', 'side', 'dessert']:
+        print('washing', dish, 'dish')
+        dish_queue.put(dish.encode('utf-8'))
+    dish_queue.put(b'quit')
+    dish_queue.join()
+    dryer_process.join()
+    dish_queue.close()
+
+# washing salad dish
+# washing bread dish
+# washing main dish
+# washing side dish
+# washing dessert dish
+# drying salad dish
+# drying bread dish
+# drying main dish
+# drying side dish
+# drying dessert dish
+
+# The asyncio version. The washer waits for join() (every dish put so far
+# has been dried) before it announces that it's done. Then the same washer
+# again, but given up on with wait_for() after 0.15 seconds: the dryers are
+# cancelled and nothing is left running.
+
+async def async_dry(dish):
+    await asyncio.sleep(0.1)
+    return 'dried {} dish'.format(dish)
+
+
+async def async_washer(dishes):
+    async with AsyncStage(async_dry, workers=3) as dryers:
+        for dish in dishes:
+            print('washing', dish, 'dish')
+            await dryers.put(dish)
+        await dryers.join()
+        print('all dishes dried')
+        await dryers.close()
+        async for result in dryers.results():
+            print(result)
+
+
+async def impatient_washer(dishes):
+    try:
+        await asyncio.wait_for(async_washer(dishes), timeout=0.15)
+    except asyncio.TimeoutError:
+        print('gave up')
+    print('tasks still running:', len(asyncio.all_tasks()) - 1)
+
+
+if __name__ == '__main__':
+    dishes = ['salad', 'bread', 'main', 'side', 'dessert']
+    asyncio.run(async_washer(dishes))
+    asyncio.run(impatient_washer(dishes))
+
+# washing salad dish
+# washing bread dish
+# washing main dish
+# washing side dish
+# washing dessert dish
+# all dishes dried
+# dried salad dish
+# dried bread dish
+# dried main dish
+# dried side dish
+# dried dessert dish
+# washing salad dish
+# washing bread dish
+# washing main dish
+# washing side dish
+# washing dessert dish
+# gave up
+# tasks still running: 0
+
+
+# Benchmark: dishes per second as dryers are added
+# -----------------------------------------------------------------------------
+# First a dryer that does next to nothing, so all that's being measured is
+# the cost of getting dishes to a dryer and back: the concurrency.py way
+# (JoinableQueue, one dish at a time) against Stage with batch_size 1 and
+# 100.
+
+# Then a dryer that waits 1ms per dish, standing in for I/O (like the
+# time.sleep() in concurrency.py), with more and more dryers.
+
+def wipe(dish):
+    return dish
+
+
+def wash(dish):
+    time.sleep(0.001)
+    return dish
+
+
+def slow_dry(dish):
+    time.sleep(0.001)
+    return dish
+
+
+def _joinable_dryer(queue, done):
+    while True:
+        dish = queue.get()
+        done.put(wipe(dish))
+        queue.task_done()
+
+
+def _joinable_queue(dishes):
+    queue = mp.JoinableQueue()
+    done = mp.Queue()
+    dryer = mp.Process(target=_joinable_dryer, args=(queue, done))
+    dryer.daemon = True
+    dryer.start()
+    start = time.perf_counter()
+    for dish in range(dishes):
+        queue.put(dish)
+    for _ in range(dishes):
+        done.get()
+    queue.join()
+    elapsed = time.perf_counter() - start
+    dryer.terminate()
+    return dishes / elapsed
+
+
+def _stage(func, dishes, workers, batch_size):
+    with Stage(func, workers, batch_size) as stage:
+        start = time.perf_counter()
+        count = sum(1 for _ in stage.map(range(dishes)))
+        elapsed = time.perf_counter() - start
+    assert count == dishes
+    return dishes / elapsed
+
+
+def benchmark(dishes: int=20000, slow_dishes: int=2000,
+              dryers=(1, 2, 4, 8, 16)):
+    print('-' * 50)
+    print('{} dishes, 1 dryer, no drying'.format(dishes))
+    print('JoinableQueue:           {:>9.0f} dishes/sec'.format(
+        _joinable_queue(dishes)))
+    for batch_size in (1, 100):
+        print('Stage, batch_size {:<3}:  {:>9.0f} dishes/sec'.format(
+            batch_size, _stage(wipe, dishes, 1, batch_size)))
+    print('{} dishes, 1ms each, batch_size 10'.format(slow_dishes))
+    for workers in dryers:
+        print('Stage, {:>2} dryers:        {:>9.0f} dishes/sec'.format(
+            workers, _stage(slow_dry, slow_dishes, workers, 10)))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+# --------------------------------------------------
+# 20000 dishes, 1 dryer, no drying
+# JoinableQueue:               44728 dishes/sec
+# Stage, batch_size 1  :      46876 dishes/sec
+# Stage, batch_size 100:    1090935 dishes/sec
+# 2000 dishes, 1ms each, batch_size 10
+# Stage,  1 dryers:              890 dishes/sec
+# Stage,  2 dryers:             1715 dishes/sec
+# Stage,  4 dryers:             3424 dishes/sec
+# Stage,  8 dryers:             6534 dishes/sec
+# Stage, 16 dryers:            10732 dishes/sec
+
+# (this was run on a machine with one CPU, which is why waiting dryers scale
+# and busy ones wouldn't. For work that keeps the CPU busy, more dryers than
+# CPUs doesn't help.)
+
+
+# Benchmark: RingQueue vs JoinableQueue
+# -----------------------------------------------------------------------------
+# One washer (this process) puts messages of one float, the time it was put,
+# and one dryer process gets them. The dryer works out each message's latency
+# (how long it spent in the queue) and sends back the median and the worst
+# when it's done. perf_counter() uses the same clock in every process on
+# Linux and macOS, so times from two processes can be compared.
+
+# Both queues hold at most 1024 messages. Without a limit, the washer gets
+# far ahead of the dryer and the latency is mostly time spent waiting in a
+# long line.
+
+def _timing_dryer(queue, report):
+    latencies = []
+    while True:
+        sent = queue.get()
+        queue.task_done()
+        if sent < 0:  # sentinel
+            break
+        latencies.append(time.perf_counter() - sent)
+    latencies.sort()
+    report.put((latencies[len(latencies) // 2], latencies[-1]))
+
+
+def _queue_timing(queue, messages):
+    report = mp.Queue()
+    dryer = mp.Process(target=_timing_dryer, args=(queue, report))
+    dryer.start()
+    start = time.perf_counter()
+    for _ in range(messages):
+        queue.put(time.perf_counter())
+    queue.put(-1.0)
+    queue.join()
+    elapsed = time.perf_counter() - start
+    median, worst = report.get()
+    dryer.join()
+    return messages / elapsed, median, worst
+
+
+def benchmark_ring(messages: int=100000):
+    ring = RingQueue(slots=1024, record='d')
+    joinable = mp.JoinableQueue(maxsize=1024)
+    results = [('JoinableQueue', _queue_timing(joinable, messages)),
+               ('RingQueue', _queue_timing(ring, messages))]
+    ring.close()
+    print('-' * 50)
+    print('{} messages'.format(messages))
+    for name, (rate, median, worst) in results:
+        print('{:<14} {:>8.0f} msgs/sec, latency median {:.3f} ms, '
+              'max {:.1f} ms'.format(name, rate, median * 1000, worst * 1000))
+
+
+if __name__ == '__main__':
+    benchmark_ring()
+
+# --------------------------------------------------
+# 100000 messages
+# JoinableQueue     59213 msgs/sec, latency median 13.597 ms, max 44.8 ms
+# RingQueue        110536 msgs/sec, latency median 6.988 ms, max 25.8 ms
+
+# On one CPU the washer and dryer take turns, so a message usually waits for
+# the washer to fill a good part of the queue before the dryer gets to run.
+# With a CPU each, the latencies are much lower for both.
+
+
+# Benchmark: finding the bottleneck
+# -----------------------------------------------------------------------------
+# A two stage pipeline, dryers.map(washers.map(dishes)), where washing takes
+# 1ms a dish and drying 3ms. The washers can go three times as fast as one
+# dryer, so the dishes pile up in front of the dryers until there's a limit
+# (maxsize) or more dryers. max depth is the most dishes that were waiting
+# in or being worked on by the stage at any one time.
+
+def _pipeline(dishes, dryers, maxsize, policy):
+    most = collections.Counter()
+
+    def hook(stats):
+        most[stats['stage']] = max(most[stats['stage']], stats['depth'])
+
+    washers = Stage(wash, 1, batch_size=10, maxsize=maxsize, hook=hook,
+                    interval=0.01)
+    dryer_stage = Stage(slow_dry_3ms, dryers, batch_size=10, maxsize=maxsize,
+                        policy=policy, name='dry', hook=hook, interval=0.01)
+    with washers, dryer_stage:
+        for _ in dryer_stage.map(washers.map(range(dishes))):
+            pass
+    for stage in (washers, dryer_stage):
+        report(stage.stats())
+        print('    max depth {}'.format(most[stage.name]))
+
+
+def slow_dry_3ms(dish):
+    time.sleep(0.003)
+    return dish
+
+
+def benchmark_backpressure(dishes: int=2000):
+    for dryers, maxsize, policy in [(1, 0, 'block'), (1, 4, 'block'),
+                                    (1, 4, 'drop'), (3, 4, 'block')]:
+        print('-' * 50)
+        print('{} dryers, maxsize {}, {}'.format(dryers, maxsize, policy))
+        _pipeline(dishes, dryers, maxsize, policy)
+
+
+if __name__ == '__main__':
+    benchmark_backpressure()
+
+# --------------------------------------------------
+# 1 dryers, maxsize 0, block
+# wash x1: 2000 done, 0 dropped, 860/sec, depth 0, busy 98%
+#     latency p50 1139.5 ms, p90 2067.4 ms, p99 2299.7 ms
+#     max depth 1990
+# dry x1: 2000 done, 0 dropped, 310/sec, depth 0, busy 99%
+#     latency p50 2115.8 ms, p90 3798.1 ms, p99 4123.7 ms
+#     max depth 1280
+# --------------------------------------------------
+# 1 dryers, maxsize 4, block
+# wash x1: 2000 done, 0 dropped, 306/sec, depth 0, busy 38%
+#     latency p50 329.1 ms, p90 353.9 ms, p99 365.5 ms
+#     max depth 80
+# dry x1: 2000 done, 0 dropped, 299/sec, depth 0, busy 99%
+#     latency p50 199.7 ms, p90 215.7 ms, p99 223.2 ms
+#     max depth 50
+# --------------------------------------------------
+# 1 dryers, maxsize 4, drop
+# wash x1: 2000 done, 0 dropped, 895/sec, depth 0, busy 99%
+#     latency p50 65.2 ms, p90 72.6 ms, p99 74.6 ms
+#     max depth 50
+# dry x1: 750 done, 1250 dropped, 315/sec, depth 0, busy 99%
+#     latency p50 150.5 ms, p90 157.8 ms, p99 161.6 ms
+#     max depth 40
+# --------------------------------------------------
+# 3 dryers, maxsize 4, block
+# wash x1: 2000 done, 0 dropped, 802/sec, depth 0, busy 98%
+#     latency p50 73.0 ms, p90 82.4 ms, p99 95.9 ms
+#     max depth 50
+# dry x3: 2000 done, 0 dropped, 795/sec, depth 0, busy 89%
+#     latency p50 32.1 ms, p90 38.2 ms, p99 51.8 ms
+#     max depth 20
+
+# With no limit, nearly every dish ends up waiting in memory and the last
+# ones wait 4 seconds. With maxsize 4 the washer is held back to the dryer's
+# pace (busy 38%): far fewer dishes are waiting and each waits less, but it
+# takes just as long overall. The dryer at 99% busy is the bottleneck, and
+# with 3 dryers the two stages are about even. Dropping keeps the washer at
+# full speed and loses the dishes the dryer has no room for.
+
+
+# Benchmark: processes vs asyncio for I/O bound dryers
+# -----------------------------------------------------------------------------
+# Each dish takes 1ms of waiting: time.sleep() for the Stage's processes,
+# asyncio.sleep() for AsyncStage's tasks. start is how long it took to get
+# the workers going.
+
+async def async_slow_dry(dish):
+    await asyncio.sleep(0.001)
+    return dish
+
+
+async def _async_stage(dishes, workers):
+    start = time.perf_counter()
+    async with AsyncStage(async_slow_dry, workers) as stage:
+        started = time.perf_counter()
+        count = 0
+        async for _ in stage.map(range(dishes)):
+            count += 1
+    assert count == dishes
+    return started - start, dishes / (time.perf_counter() - started)
+
+
+def _process_stage(dishes, workers):
+    start = time.perf_counter()
+    with Stage(slow_dry, workers, batch_size=10) as stage:
+        started = time.perf_counter()
+        count = sum(1 for _ in stage.map(range(dishes)))
+    assert count == dishes
+    return started - start, dishes / (time.perf_counter() - started)
+
+
+def benchmark_asyncio(dishes: int=5000, dryers=(4, 16, 64, 256)):
+    print('-' * 50)
+    print('{} dishes, 1ms each'.format(dishes))
+    print('{:>6}  {:>20}  {:>20}'.format('', 'processes', 'asyncio'))
+    print('{:>6}  {:>10}{:>10}  {:>10}{:>10}'.format(
+        'dryers', 'start ms', '/sec', 'start ms', '/sec'))
+    for workers in dryers:
+        process_start, process_rate = _process_stage(dishes, workers)
+        async_start, async_rate = asyncio.run(_async_stage(dishes, workers))
+        print('{:>6}  {:>10.1f}{:>10.0f}  {:>10.1f}{:>10.0f}'.format(
+            workers, process_start * 1000, process_rate,
+            async_start * 1000, async_rate))
+
+
+if __name__ == '__main__':
+    benchmark_asyncio()
+
+# --------------------------------------------------
+# 5000 dishes, 1ms each
+#                    processes               asyncio
+# dryers    start ms      /sec    start ms      /sec
+#      4        17.4      2908         0.1      2692
+#     16        36.0      9906         0.3     10549
+#     64       190.4     20972         0.3     24287
+#    256       883.7      8407         1.1     67612
+
+# (on a machine with one CPU)
+# Up to a few dozen dryers they keep up with each other, but a process
+# costs milliseconds to start and megabytes of memory, where a task costs
+# microseconds and a few KB. With 256 processes on one CPU the operating
+# system spends its time switching between them, while 256 tasks are still
+# just one thread.
@@ -0,0 +1,642 @@
+'''A stand-in Redis server'''
+
+
+# The Redis examples in concurrency.py and the redis_*.py files here need a
+# Redis server running. FakeRedis is a small server written in python that
+# speaks the same protocol (RESP, see the link below) for the handful of
+# commands these demos use, so they, and the benchmarks that go with them,
+# can run without installing Redis. The real redis-py client talks to it
+# exactly as it would to Redis.
+
+# Like Redis, it runs one command at a time (here by holding one lock while a
+# command runs), so every command is atomic, and a client that sends several
+# commands at once (a pipeline) gets all the replies back in one go.
+
+# It is not Redis: everything is kept in memory in this process and is gone
+# when it stops, there's no Lua (EVAL), and it's much slower. Benchmarks run
+# against it are good for comparing one way of using Redis with another, not
+# for telling how fast Redis is.
+
+# Usage:
+
+# with FakeRedis() as server:
+#     conn = redis.Redis(port=server.port)
+
+# Or from the command line, in place of redis-server:
+# $ python3 fake_redis.py
+
+# https://redis.io/docs/latest/develop/reference/protocol-spec/
+
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+
+
+# The protocol
+# -----------------------------------------------------------------------------
+# A command is an array of bulk strings: *<count>\r\n then $<length>\r\n
+# <bytes>\r\n for each argument. Replies are one of:
+
+# +OK\r\n               simple string
+# -ERR message\r\n      error
+# :42\r\n               integer
+# $5\r\nhello\r\n       bulk string ($-1\r\n is None)
+# *2\r\n...             array of any of these (*-1\r\n is None)
+
+# That's RESP2. Newer clients (redis-py 5 and later by default) start with
+# HELLO 3 to switch to RESP3, which adds a few types. The ones used here are
+# _\r\n for None, %<count> for a map (e.g. HGETALL's reply), ~<count> for a
+# set (SMEMBERS) and ><count> for pushed data that the client didn't ask for
+# (pub/sub messages).
+
+class Error(Exception):
+    pass
+
+
+class Simple(str):
+    pass
+
+
+class Replies(list):
+    # more than one reply to one command (SUBSCRIBE to several channels)
+    pass
+
+
+class Map(dict):
+    pass
+
+
+class Push(list):
+    pass
+
+
+OK = Simple('OK')
+
+
+def encode(reply, protocol=2):
+    if reply is None:
+        return b'_\r\n' if protocol == 3 else b'$-1\r\n'
+    if isinstance(reply, Error):
+        return '-{}\r\n'.format(reply).encode('utf-8')
+    if isinstance(reply, Simple):
+        return '+{}\r\n'.format(reply).encode('utf-8')
+    if isinstance(reply, bool):
+        reply = int(reply)
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, str):
+        reply = reply.encode('utf-8')
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    if isinstance(reply, Replies):
+        return b''.join(encode(r, protocol) for r in reply)
+    if isinstance(reply, Map):
+        if protocol == 3:
+            return b'%%%d\r\n' % len(reply) + b''.join(
+                encode(k, protocol) + encode(v, protocol)
+                for k, v in reply.items())
+        reply = [item for pair in reply.items() for item in pair]
+    kind = b'*'
+    if protocol == 3 and isinstance(reply, Push):
+        kind = b'>'
+    elif protocol == 3 and isinstance(reply, set):
+        kind = b'~'
+    return kind + b'%d\r\n' % len(reply) + b''.join(
+        encode(r, protocol) for r in reply)
+
+
+def parse(buffer, start=0):
+    # Returns (command arguments, where the next command starts) or
+    # (None, start) if the buffer doesn't hold a whole command yet.
+    if buffer[start:start + 1] != b'*':
+        # an inline command, e.g. typed into telnet: PING\r\n
+        end = buffer.find(b'\r\n', start)
+        if end < 0:
+            return None, start
+        return bytes(buffer[start:end]).split(), end + 2
+    end = buffer.find(b'\r\n', start)
+    if end < 0:
+        return None, start
+    count = int(buffer[start + 1:end])
+    position = end + 2
+    args = []
+    for _ in range(count):
+        end = buffer.find(b'\r\n', position)
+        if end < 0:
+            return None, start
+        length = int(buffer[position + 1:end])
+        position = end + 2
+        if len(buffer) < position + length + 2:
+            return None, start
+        args.append(bytes(buffer[position:position + length]))
+        position += length + 2
+    return args, position
+
+
+# The data
+# -----------------------------------------------------------------------------
+# Keys map to bytes (strings), lists, dicts (hashes) or sets. Each command
+# is a cmd_<name> method. Commands that wait (BLPOP, BLMOVE) wait on the same
+# Condition that guards the data, which lets the other clients' commands run
+# in the meantime; anything that adds to a list wakes them up.
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise Error('ERR value is not an integer or out of range')
+
+
+class Store():
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}    # key -> time.monotonic() it expires at
+        self.channels = {}   # channel -> set of subscribed clients
+        self.cond = threading.Condition(threading.RLock())
+        self.closed = False
+
+    def execute(self, client, args):
+        name = args[0].decode('utf-8', 'replace').lower()
+        command = getattr(self, 'cmd_' + name, None)
+        if command is None:
+            return Error("ERR unknown command '{}'".format(name))
+        if client.multi is not None and name not in ('exec', 'discard',
+                                                     'multi'):
+            client.multi.append((command, args[1:]))
+            return Simple('QUEUED')
+        with self.cond:
+            try:
+                return command(client, *args[1:])
+            except TypeError:
+                return Error("ERR wrong number of arguments for '{}' "
+                             "command".format(name))
+            except Error as e:
+                return e
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # keys
+
+    def _get(self, key, kind=None):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._delete(key)
+        value = self.data.get(key)
+        if value is not None and kind is not None and \
+                not isinstance(value, kind):
+            raise Error('WRONGTYPE Operation against a key holding the '
+                        'wrong kind of value')
+        return value
+
+    def _delete(self, key):
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def cmd_ping(self, client, message=None):
+        if client.channels:
+            return Push([b'pong', message or b''])
+        return Simple('PONG') if message is None else message
+
+    def cmd_echo(self, client, message):
+        return message
+
+    def cmd_hello(self, client, protocol=b'2', *options):
+        if protocol not in (b'2', b'3'):
+            raise Error('NOPROTO unsupported protocol version')
+        client.protocol = int(protocol)
+        return Map({b'server': b'redis', b'version': b'7.2.0',
+                    b'proto': client.protocol, b'id': id(client),
+                    b'mode': b'standalone', b'role': b'master',
+                    b'modules': []})
+
+    def cmd_client(self, client, *args):
+        return OK
+
+    def cmd_select(self, client, db):
+        return OK
+
+    def cmd_flushall(self, client, *args):
+        self.data.clear()
+        self.expires.clear()
+        return OK
+
+    cmd_flushdb = cmd_flushall
+
+    def cmd_dbsize(self, client):
+        return sum(1 for key in list(self.data) if self._get(key) is not None)
+
+    def cmd_del(self, client, *keys):
+        return sum(self._delete(key) for key in keys)
+
+    def cmd_exists(self, client, *keys):
+        return sum(self._get(key) is not None for key in keys)
+
+    def cmd_keys(self, client, pattern):
+        pattern = pattern.decode('utf-8')
+        return [key for key in list(self.data)
+                if self._get(key) is not None and
+                fnmatch.fnmatchcase(key.decode('utf-8'), pattern)]
+
+    def cmd_expire(self, client, key, seconds):
+        if self._get(key) is None:
+            return 0
+        self.expires[key] = time.monotonic() + _int(seconds)
+        return 1
+
+    def cmd_ttl(self, client, key):
+        if self._get(key) is None:
+            return -2
+        if key not in self.expires:
+            return -1
+        return round(self.expires[key] - time.monotonic())
+
+    # strings
+
+    def cmd_get(self, client, key):
+        return self._get(key, bytes)
+
+    def cmd_set(self, client, key, value, *options):
+        options = [option.upper() for option in options]
+        exists = self._get(key) is not None
+        if (b'NX' in options and exists) or (b'XX' in options and
+                                             not exists):
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for unit, scale in ((b'EX', 1), (b'PX', 0.001)):
+            if unit in options:
+                ttl = _int(options[options.index(unit) + 1]) * scale
+                self.expires[key] = time.monotonic() + ttl
+        return OK
+
+    def cmd_incrby(self, client, key, amount):
+        value = _int(self._get(key, bytes) or b'0') + _int(amount)
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def cmd_incr(self, client, key):
+        return self.cmd_incrby(client, key, b'1')
+
+    # lists
+
+    def _list(self, key, create=False):
+        value = self._get(key, list)
+        if value is None and create:
+            value = self.data[key] = []
+        return value
+
+    def _tidy(self, key):
+        # like Redis, an empty list (hash, set) doesn't exist
+        if not self.data.get(key, True):
+            self._delete(key)
+
+    def cmd_rpush(self, client, key, *values):
+        if not values:
+            raise TypeError
+        items = self._list(key, create=True)
+        items.extend(values)
+        self.cond.notify_all()
+        return len(items)
+
+    def cmd_lpush(self, client, key, *values):
+        if not values:
+            raise TypeError
+        items = self._list(key, create=True)
+        items[:0] = reversed(values)
+        self.cond.notify_all()
+        return len(items)
+
+    def _pop(self, key, count, left):
+        items = self._list(key)
+        if not items:
+            return None
+        if count is None:
+            value = items.pop(0 if left else -1)
+        else:
+            count = _int(count)
+            if left:
+                value, items[:count] = items[:count], []
+            else:
+                value = items[-count:][::-1] if count else []
+                del items[len(items) - len(value):]
+        self._tidy(key)
+        return value
+
+    def cmd_lpop(self, client, key, count=None):
+        return self._pop(key, count, left=True)
+
+    def cmd_rpop(self, client, key, count=None):
+        return self._pop(key, count, left=False)
+
+    def cmd_llen(self, client, key):
+        return len(self._list(key) or ())
+
+    def cmd_lrange(self, client, key, start, stop):
+        items = self._list(key) or []
+        start, stop = _int(start), _int(stop)
+        if stop < 0:
+            stop += len(items)
+        return items[start if start >= 0 else max(0, len(items) + start):
+                     stop + 1]
+
+    def cmd_lrem(self, client, key, count, value):
+        items = self._list(key)
+        if not items:
+            return 0
+        count = _int(count)
+        positions = [i for i, item in enumerate(items) if item == value]
+        if count > 0:
+            positions = positions[:count]
+        elif count < 0:
+            positions = positions[count:]
+        for i in reversed(positions):
+            del items[i]
+        self._tidy(key)
+        return len(positions)
+
+    def cmd_lmove(self, client, source, destination, wherefrom, whereto):
+        value = self._pop(source, None, wherefrom.upper() == b'LEFT')
+        if value is not None:
+            items = self._list(destination, create=True)
+            if whereto.upper() == b'LEFT':
+                items.insert(0, value)
+            else:
+                items.append(value)
+            self.cond.notify_all()
+        return value
+
+    def cmd_rpoplpush(self, client, source, destination):
+        return self.cmd_lmove(client, source, destination, b'RIGHT', b'LEFT')
+
+    def _block(self, timeout, attempt):
+        # timeout 0 means wait forever
+        timeout = float(timeout)
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            result = attempt()
+            if result is not None or self.closed:
+                return result
+            if deadline is None:
+                self.cond.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def cmd_blpop(self, client, *args):
+        keys, timeout = args[:-1], args[-1]
+        if not keys:
+            raise TypeError
+
+        def attempt():
+            for key in keys:
+                value = self._pop(key, None, left=True)
+                if value is not None:
+                    return [key, value]
+        return self._block(timeout, attempt)
+
+    def cmd_blmove(self, client, source, destination, wherefrom, whereto,
+                   timeout):
+        return self._block(timeout, lambda: self.cmd_lmove(
+            client, source, destination, wherefrom, whereto))
+
+    def cmd_brpoplpush(self, client, source, destination, timeout):
+        return self._block(timeout, lambda: self.cmd_lmove(
+            client, source, destination, b'RIGHT', b'LEFT'))
+
+    # hashes
+
+    def cmd_hset(self, client, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        fields = self._get(key, dict)
+        if fields is None:
+            fields = self.data[key] = {}
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in fields
+            fields[field] = value
+        return added
+
+    def cmd_hget(self, client, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def cmd_hdel(self, client, key, *fields):
+        values = self._get(key, dict) or {}
+        removed = sum(values.pop(field, None) is not None for field in fields)
+        self._tidy(key)
+        return removed
+
+    def cmd_hgetall(self, client, key):
+        return Map(self._get(key, dict) or {})
+
+    def cmd_hlen(self, client, key):
+        return len(self._get(key, dict) or ())
+
+    # sets
+
+    def cmd_sadd(self, client, key, *members):
+        if not members:
+            raise TypeError
+        values = self._get(key, set)
+        if values is None:
+            values = self.data[key] = set()
+        added = len(set(members) - values)
+        values.update(members)
+        return added
+
+    def cmd_srem(self, client, key, *members):
+        values = self._get(key, set) or set()
+        removed = len(values.intersection(members))
+        values.difference_update(members)
+        self._tidy(key)
+        return removed
+
+    def cmd_smembers(self, client, key):
+        return set(self._get(key, set) or ())
+
+    def cmd_sismember(self, client, key, member):
+        return member in (self._get(key, set) or ())
+
+    def cmd_scard(self, client, key):
+        return len(self._get(key, set) or ())
+
+    # transactions: MULTI queues the commands, EXEC runs them all at once
+
+    def cmd_multi(self, client):
+        if client.multi is not None:
+            raise Error('ERR MULTI calls can not be nested')
+        client.multi = []
+        return OK
+
+    def cmd_exec(self, client):
+        if client.multi is None:
+            raise Error('ERR EXEC without MULTI')
+        queued, client.multi = client.multi, None
+        results = []
+        for command, args in queued:
+            try:
+                results.append(command(client, *args))
+            except Error as e:
+                results.append(e)
+        return results
+
+    def cmd_discard(self, client):
+        if client.multi is None:
+            raise Error('ERR DISCARD without MULTI')
+        client.multi = None
+        return OK
+
+    # pub/sub: PUBLISH doesn't write to the subscribers itself (that could
+    # hold everyone up if one subscriber is slow to read); it leaves the
+    # messages in client.deliveries to be sent once the lock is released
+
+    def cmd_publish(self, client, channel, message):
+        subscribers = self.channels.get(channel, ())
+        for subscriber in subscribers:
+            client.deliveries.append(
+                (subscriber, Push([b'message', channel, message])))
+        return len(subscribers)
+
+    def cmd_subscribe(self, client, *channels):
+        replies = Replies()
+        for channel in channels:
+            self.channels.setdefault(channel, set()).add(client)
+            client.channels.add(channel)
+            replies.append(Push([b'subscribe', channel,
+                                 len(client.channels)]))
+        return replies
+
+    def cmd_unsubscribe(self, client, *channels):
+        replies = Replies()
+        for channel in channels or list(client.channels):
+            self.channels.get(channel, set()).discard(client)
+            client.channels.discard(channel)
+            replies.append(Push([b'unsubscribe', channel,
+                                 len(client.channels)]))
+        return replies
+
+    def cmd_pubsub(self, client, subcommand, *args):
+        # PUBSUB NUMSUB, so a publisher can wait for its subscribers
+        if subcommand.lower() != b'numsub':
+            raise Error('ERR unknown PUBSUB subcommand')
+        reply = []
+        for channel in args:
+            reply += [channel, len(self.channels.get(channel, ()))]
+        return reply
+
+    def forget(self, client):
+        with self.cond:
+            for channel in client.channels:
+                self.channels.get(channel, set()).discard(client)
+
+
+# The server
+# -----------------------------------------------------------------------------
+# One thread per client connection (socketserver.ThreadingTCPServer). Each
+# recv() can hold any number of commands; they're all run and the replies
+# sent back with one sendall(), which is what makes pipelining pay off.
+
+class _Client(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.multi = None
+        self.protocol = 2
+        self.channels = set()
+        self.deliveries = []
+        self.write_lock = threading.Lock()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data):
+        with self.write_lock:
+            try:
+                self.request.sendall(data)
+            except OSError:
+                pass
+
+    def handle(self):
+        store = self.server.store
+        buffer = bytearray()
+        while not store.closed:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            replies = []
+            position = 0
+            while True:
+                args, position = parse(buffer, position)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                if args[0].upper() == b'QUIT':
+                    self.send(b''.join(replies) + encode(OK))
+                    return
+                reply = store.execute(self, args)
+                replies.append(encode(reply, self.protocol))
+            del buffer[:position]
+            if replies:
+                self.send(b''.join(replies))
+            deliveries, self.deliveries = self.deliveries, []
+            for subscriber, message in deliveries:
+                subscriber.send(encode(message, subscriber.protocol))
+
+    def finish(self):
+        self.server.store.forget(self)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeRedis():
+
+    def __init__(self, host='127.0.0.1', port=0):
+        # port=0 picks any free port; see self.port
+        self.server = _Server((host, port), _Client)
+        self.server.store = Store()
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.store.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    server = FakeRedis(port=6379)
+    print('FakeRedis listening on port {}, control c to stop'.format(
+        server.port))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.store.close()
+        server.server.server_close()
@@ -0,0 +1,93 @@
+# Compares redis_washer.py / redis_dryer.py, one round trip per dish, with
+# redis_batch_washer.py / redis_batch_dryer.py. It runs its own FakeRedis
+# (fake_redis.py) so no Redis server is needed. The dryers are processes,
+# like in redis_dryer.py, and don't sleep, so all that's being timed is
+# getting the dishes through Redis.
+
+import multiprocessing
+import time
+import redis
+
+from fake_redis import FakeRedis
+from redis_batch_dryer import dry
+from redis_batch_washer import wash
+
+
+def wash_one_by_one(conn, dishes, dryers):
+    # what redis_washer.py does
+    for dish in dishes:
+        conn.rpush('dishes', dish.encode('utf-8'))
+    for _ in range(dryers):
+        conn.rpush('dishes', 'quit')
+
+
+def dry_one_by_one(conn):
+    # what redis_dryer.py does
+    dried = 0
+    while True:
+        msg = conn.blpop('dishes', 20)
+        if not msg or msg[1] == b'quit':
+            return dried
+        dried += 1
+
+
+def _dryer(port, batch_size, done):
+    conn = redis.Redis(port=port)
+    if batch_size:
+        done.put(dry(conn, batch_size))
+    else:
+        done.put(dry_one_by_one(conn))
+
+
+def run(port, dishes, dryers, batch_size):
+    conn = redis.Redis(port=port)
+    conn.delete('dishes')
+    done = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_dryer,
+                                         args=(port, batch_size, done))
+                 for _ in range(dryers)]
+    for p in processes:
+        p.start()
+    start = time.perf_counter()
+    if batch_size:
+        wash(conn, dishes, batch_size, dryers)
+    else:
+        wash_one_by_one(conn, dishes, dryers)
+    dried = sum(done.get() for _ in processes)
+    elapsed = time.perf_counter() - start
+    for p in processes:
+        p.join()
+    assert dried == len(dishes), dried
+    return len(dishes) / elapsed
+
+
+def benchmark(count=20000):
+    dishes = ['dish{}'.format(i) for i in range(count)]
+    with FakeRedis() as server:
+        print('-' * 50)
+        print('{} dishes'.format(count))
+        for dryers in (1, 3):
+            for batch_size in (0, 10, 100):
+                name = 'one by one' if not batch_size else \
+                    'batches of {}'.format(batch_size)
+                print('{} dryers, {:<15} {:>8.0f} dishes/sec'.format(
+                    dryers, name + ':', run(server.port, dishes, dryers,
+                                            batch_size)))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+# --------------------------------------------------
+# 20000 dishes
+# 1 dryers, one by one:         4450 dishes/sec
+# 1 dryers, batches of 10:      9114 dishes/sec
+# 1 dryers, batches of 100:    14544 dishes/sec
+# 3 dryers, one by one:         3698 dishes/sec
+# 3 dryers, batches of 10:     18608 dishes/sec
+# 3 dryers, batches of 100:    35830 dishes/sec
+
+# One by one, extra dryers don't help: they're all waiting their turn for a
+# round trip to the same server. With batches, each round trip moves
+# batch_size dishes. Against a real Redis over a network, where a round trip
+# is a much bigger share of the cost, the difference is bigger.
@@ -0,0 +1,64 @@
+# A batched version of redis_dryer.py. Instead of one blpop() per dish,
+# drain() takes up to batch_size dishes in one round trip with LPOP and a
+# count (Redis 6.2 or later). Only when the list is empty does it fall back
+# to blpop() to wait for the next dish.
+
+# Each dryer stops at the first 'quit' it sees. A batch can hold more than
+# one 'quit' (the washer sends one per dryer) so anything after the first
+# one is pushed back for the other dryers.
+
+import multiprocessing
+import os
+import time
+import redis
+
+
+def drain(conn, batch_size, timeout):
+    items = conn.lpop('dishes', batch_size)
+    if not items:
+        msg = conn.blpop('dishes', timeout)
+        if not msg:
+            return None
+        items = [msg[1]]
+    return items
+
+
+def dry(conn, batch_size=100, timeout=20, seconds=0.0, verbose=False):
+    # returns the number of dishes dried
+    pid = os.getpid()
+    dried = 0
+    while True:
+        items = drain(conn, batch_size, timeout)
+        if items is None:
+            break
+        if b'quit' in items:
+            stop = items.index(b'quit')
+            rest = items[stop + 1:]
+            if rest:
+                conn.lpush('dishes', *reversed(rest))
+            items = items[:stop]
+        else:
+            stop = None
+        for item in items:
+            if verbose:
+                print('{} dried {}'.format(pid, item.decode('utf-8')))
+            time.sleep(seconds)
+        dried += len(items)
+        if stop is not None:
+            break
+    return dried
+
+
+def dryer(port=6379, batch_size=100):
+    conn = redis.Redis(port=port)
+    pid = os.getpid()
+    print('Dryer process {} is starting'.format(pid))
+    dry(conn, batch_size, seconds=0.1, verbose=True)
+    print('dryer process {} is done'.format(pid))
+
+
+if __name__ == '__main__':
+    DRYERS = 3
+    for num in range(DRYERS):
+        p = multiprocessing.Process(target=dryer)
+        p.start()
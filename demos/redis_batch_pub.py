@@ -0,0 +1,122 @@
+# A batched version of redis_pub.py. redis_pub.py makes one conn.publish()
+# call per message, so each message costs a round trip to the server, and
+# every subscriber gets it as a message of its own.
+
+# BatchPublisher holds on to messages for up to window seconds, or until a
+# channel has max_batch of them, then:
+# – coalesces the messages for each channel into one JSON list, published
+#   as a single message, so a subscriber gets a whole batch at a time
+# – sends the PUBLISH for every channel through one pipeline, one round trip
+#   for all of them.
+
+# The cost is latency: a message can wait up to window seconds before it's
+# sent. publish() never blocks on the network; a background thread does the
+# sending. The messages have to be things json can handle (publish() raises
+# TypeError if not). Subscribers need to know a message is a batch;
+# redis_batch_sub.py does.
+
+# If sending fails (Redis is down, say) the messages go back to wait with
+# the rest and the thread tries again, waiting twice as long each time up
+# to a second. Meanwhile publish() raises the error rather than keep piling
+# up messages that can't be sent; once a send works again, so does
+# publish(). (redis-py's own retries, set with Redis(retry=...), come
+# first: until they give up, publish() just keeps collecting messages.)
+
+import json
+import random
+import threading
+import time
+import redis
+
+
+class BatchPublisher():
+
+    def __init__(self, conn, window=0.005, max_batch=100):
+        self.conn = conn
+        self.window = window
+        self.max_batch = max_batch
+        self.published = 0
+        self.error = None  # why the last send failed, until one works
+        self._batches = {}  # channel -> messages waiting to be sent
+        self._lock = threading.Lock()
+        # held from taking the batches to sending them, so that two flushes
+        # (the thread's and one called directly) can't overtake each other
+        self._sending = threading.Lock()
+        self._full = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def publish(self, channel, message):
+        with self._lock:
+            if self._closed:
+                raise ValueError('publisher is closed')
+            if self.error is not None:
+                raise self.error
+            batch = self._batches.setdefault(channel, [])
+            batch.append(json.dumps(message))
+            if len(batch) >= self.max_batch:
+                self._full.set()
+
+    def flush(self):
+        with self._sending:
+            with self._lock:
+                batches, self._batches = self._batches, {}
+                self._full.clear()
+            if not batches:
+                return
+            pipe = self.conn.pipeline(transaction=False)
+            for channel, messages in batches.items():
+                # each message is already JSON, so the list is just joined up
+                pipe.publish(channel, '[' + ','.join(messages) + ']')
+            try:
+                pipe.execute()
+            except redis.RedisError:
+                # back in front of anything published since
+                with self._lock:
+                    for channel, messages in self._batches.items():
+                        batches.setdefault(channel, []).extend(messages)
+                    self._batches = batches
+                raise
+            self.published += sum(len(m) for m in batches.values())
+
+    def _run(self):
+        wait = self.window
+        while not self._closed:
+            self._full.wait(wait)
+            try:
+                self.flush()
+            except redis.RedisError as e:
+                self.error = e
+                self._full.clear()
+                wait = min(1.0, wait * 2)
+            else:
+                self.error = None
+                wait = self.window
+
+    def close(self):
+        # sends anything still waiting
+        self._closed = True
+        self._full.set()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    conn = redis.Redis()
+    cats = ['siamese', 'black', 'persian', 'main coon', 'tabby', 'norwegian']
+    hats = ['bowler', 'fedora', 'top hat', 'poor boy', 'cowboy', 'stovepipe']
+
+    with BatchPublisher(conn) as publisher:
+        for i in range(10):
+            cat = random.choice(cats)
+            hat = random.choice(hats)
+            print('Publish: {} cat wears a {}'.format(cat, hat))
+            publisher.publish(cat, hat)
+            time.sleep(0.001)
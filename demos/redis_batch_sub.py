@@ -0,0 +1,116 @@
+# A batched version of redis_sub.py, to go with redis_batch_pub.py. Each
+# message from BatchPublisher is a JSON list of messages for one channel.
+# BatchSubscriber passes them to that channel's handler as a list, on a pool
+# of worker threads, so the loop reading from Redis never waits for a
+# handler:
+
+# handler(channel, messages)
+
+# Each channel has at most one batch being handled at a time, so a channel's
+# messages are handled in the order they were published. While a batch is
+# being handled, anything else that arrives for that channel waits and goes
+# to the handler as one batch (up to max_batch) when it's done. So the
+# busier a channel gets, the bigger its batches, and the fewer calls per
+# message. Different channels are handled at the same time, up to workers.
+
+# A handler that raises doesn't stop anything else: the exception is printed
+# and counted in errors. So is a message that isn't a JSON list (one from
+# redis_pub.py, say), which is skipped. stop() can be called from a handler
+# (or any other thread) and run() returns once everything received has been
+# handled.
+
+import json
+import threading
+import traceback
+import redis
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatchSubscriber():
+
+    def __init__(self, conn, handlers, workers=4, max_batch=1000):
+        # handlers is a dict of channel -> handler
+        self.handlers = {channel.encode('utf-8')
+                         if isinstance(channel, str) else channel: handler
+                         for channel, handler in handlers.items()}
+        self.max_batch = max_batch
+        self.handled = 0
+        self.batches = 0
+        self.errors = 0
+        self._pending = {}  # channel -> messages waiting for the handler
+        self._running = set()  # channels with a batch being handled
+        self._lock = threading.Condition()
+        self._stopped = False
+        self._pool = ThreadPoolExecutor(workers)
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*self.handlers)
+
+    def run(self):
+        try:
+            while not self._stopped:
+                msg = self.pubsub.get_message(timeout=0.1)
+                if msg and msg['type'] == 'message':
+                    try:
+                        messages = json.loads(msg['data'])
+                        if not isinstance(messages, list):
+                            raise TypeError('not a batch')
+                    except (ValueError, TypeError):
+                        with self._lock:
+                            self.errors += 1
+                        continue
+                    self._add(msg['channel'], messages)
+            self.join()
+        finally:
+            self._pool.shutdown()
+            self.pubsub.close()
+
+    def stop(self):
+        self._stopped = True
+
+    def join(self):
+        # waits until everything received so far has been handled
+        with self._lock:
+            self._lock.wait_for(
+                lambda: not self._running and not any(self._pending.values()))
+
+    def _add(self, channel, messages):
+        with self._lock:
+            self._pending.setdefault(channel, []).extend(messages)
+            if channel not in self._running:
+                self._submit(channel)
+
+    def _submit(self, channel):
+        # with self._lock held
+        pending = self._pending[channel]
+        batch = pending[:self.max_batch]
+        del pending[:self.max_batch]
+        self._running.add(channel)
+        self._pool.submit(self._handle, channel, batch)
+
+    def _handle(self, channel, batch):
+        failed = False
+        try:
+            self.handlers[channel](channel.decode('utf-8'), batch)
+        except Exception:
+            traceback.print_exc()
+            failed = True
+        with self._lock:
+            self.errors += failed
+            self.handled += len(batch)
+            self.batches += 1
+            self._running.discard(channel)
+            if self._pending[channel]:
+                self._submit(channel)
+            self._lock.notify_all()
+
+
+if __name__ == '__main__':
+    conn = redis.Redis()
+    topics = ['siamese', 'black']
+
+    def wears(cat, hats):
+        for hat in hats:
+            print('Subscribe: {} cat wears a {}'.format(cat, hat))
+
+    BatchSubscriber(conn, {topic: wears for topic in topics}).run()
@@ -0,0 +1,36 @@
+# A batched version of redis_washer.py (see Queues across Networks in
+# concurrency.py). redis_washer.py sends one rpush() per dish and waits for
+# the reply, so each dish costs a round trip to the server and a command
+# for the server to run. Here the dishes are pushed batch_size at a time
+# with one RPUSH each (RPUSH takes any number of values), sent through a
+# pipeline. The pipeline holds the commands until execute() and sends them
+# all in one go, so anything else that goes with a batch, like the 'quit'
+# sentinels at the end, shares its round trip. transaction=False because
+# nothing here needs to be a MULTI/EXEC transaction.
+
+import redis
+
+
+def wash(conn, dishes, batch_size=100, dryers=1, verbose=False):
+    pipe = conn.pipeline(transaction=False)
+    batch = []
+    for dish in dishes:
+        batch.append(dish.encode('utf-8'))
+        if verbose:
+            print('washed', dish)
+        if len(batch) >= batch_size:
+            pipe.rpush('dishes', *batch)
+            pipe.execute()
+            batch = []
+    if batch:
+        pipe.rpush('dishes', *batch)
+    pipe.rpush('dishes', *['quit'] * dryers)  # a sentinel for each dryer
+    pipe.execute()
+
+
+if __name__ == '__main__':
+    conn = redis.Redis()
+    print('Washer is starting')
+    dishes = ['salad', 'bread', 'main', 'side', 'dessert']
+    wash(conn, dishes, batch_size=2, dryers=3, verbose=True)
+    print('Washer is done')
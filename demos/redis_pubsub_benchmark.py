@@ -0,0 +1,141 @@
+# Compares redis_pub.py / redis_sub.py, one PUBLISH and one handler call per
+# message, with redis_batch_pub.py / redis_batch_sub.py. Like
+# redis_batch_benchmark.py it runs its own FakeRedis (fake_redis.py) and the
+# subscriber is a separate process.
+
+# Each message carries the time.time() it was published at, and the
+# subscriber's handler works out how long it took to get there. Two runs
+# for each:
+# – flood: publish count messages as fast as possible; msgs/sec is count
+#   over the time from the first publish to the last message handled.
+# – paced: publish rate messages a second for two seconds, well within what
+#   both can keep up with, to see the latency on its own. The batched
+#   publisher adds up to window seconds to that.
+
+import multiprocessing
+import statistics
+import threading
+import time
+import redis
+
+from fake_redis import FakeRedis
+from redis_batch_pub import BatchPublisher
+from redis_batch_sub import BatchSubscriber
+
+cats = ['siamese', 'black', 'persian', 'main coon', 'tabby', 'norwegian']
+hats = ['bowler', 'fedora', 'top hat', 'poor boy', 'cowboy', 'stovepipe']
+
+
+def subscribe_one_by_one(port, count, results):
+    # what redis_sub.py does
+    conn = redis.Redis(port=port)
+    sub = conn.pubsub(ignore_subscribe_messages=True)
+    sub.subscribe(*cats)
+    latencies = []
+
+    def wears(cat, hat):
+        hat, sent = hat.rsplit(' ', 1)
+        latencies.append(time.time() - float(sent))
+
+    for msg in sub.listen():
+        wears(msg['channel'].decode('utf-8'), msg['data'].decode('utf-8'))
+        if len(latencies) == count:
+            break
+    results.put((time.time(), latencies))
+
+
+def subscribe_batched(port, count, results):
+    conn = redis.Redis(port=port)
+    latencies = []
+    lock = threading.Lock()
+
+    def wears(cat, hats):
+        now = time.time()
+        with lock:
+            latencies.extend(now - sent for hat, sent in hats)
+            if len(latencies) == count:
+                subscriber.stop()
+
+    subscriber = BatchSubscriber(conn, {cat: wears for cat in cats})
+    subscriber.run()
+    results.put((time.time(), latencies))
+
+
+def publish(conn, publisher, count, rate):
+    # rate=None is as fast as possible, otherwise rate messages a second
+    start = time.perf_counter()
+    for i in range(count):
+        if rate:
+            wait = start + i / rate - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        cat = cats[i % len(cats)]
+        hat = hats[i % len(hats)]
+        if publisher:
+            publisher.publish(cat, (hat, time.time()))
+        else:
+            conn.publish(cat, '{} {}'.format(hat, time.time()))
+
+
+def run(port, count, batched, rate=None):
+    conn = redis.Redis(port=port)
+    results = multiprocessing.Queue()
+    target = subscribe_batched if batched else subscribe_one_by_one
+    process = multiprocessing.Process(target=target,
+                                      args=(port, count, results))
+    process.start()
+    while any(n < 1 for cat, n in conn.pubsub_numsub(*cats)):
+        time.sleep(0.01)
+
+    start = time.time()
+    if batched:
+        with BatchPublisher(conn) as publisher:
+            publish(conn, publisher, count, rate)
+    else:
+        publish(conn, None, count, rate)
+    finished, latencies = results.get()
+    process.join()
+    assert len(latencies) == count, len(latencies)
+    latencies = sorted(latencies)
+    return (count / (finished - start),
+            statistics.median(latencies) * 1000,
+            latencies[int(count * 0.99)] * 1000)
+
+
+def benchmark(count=20000, rate=2000):
+    with FakeRedis() as server:
+        print('-' * 62)
+        print('{} messages over {} channels'.format(count, len(cats)))
+        print('{:<22}{:>14}{:>13}{:>13}'.format(
+            '', 'msgs/sec', 'p50 ms', 'p99 ms'))
+        for name, paced in (('flood', None), ('paced', rate)):
+            for batched in (False, True):
+                label = '{}, {}:'.format(
+                    name, 'batched' if batched else 'one by one')
+                n = count if not paced else rate * 2
+                print('{:<22}{:>14.0f}{:>13.2f}{:>13.2f}'.format(
+                    label, *run(server.port, n, batched, paced)))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+# --------------------------------------------------------------
+# 20000 messages over 6 channels
+#                             msgs/sec       p50 ms       p99 ms
+# flood, one by one:              8595         0.13         0.24
+# flood, batched:                98903         6.85        11.75
+# paced, one by one:              2000         0.19         0.42
+# paced, batched:                 1903         3.68         6.28
+
+# Flooding, the batched version gets about 11 times as many messages
+# through. One by one, the publisher waits for a round trip per message, so
+# the subscriber is never behind and latency stays low. Batched, the
+# publisher gets ahead and a message's latency is mostly time spent waiting
+# behind the ones before it.
+
+# Paced (msgs/sec there is just the rate they were published at), a batched
+# message waits in the publisher for the rest of its window (5ms), which is
+# most of its latency. That's the trade: pick window for the latency you can
+# afford. The p99s are noisy because everything here, FakeRedis included,
+# shares one CPU.
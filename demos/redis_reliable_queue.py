@@ -0,0 +1,296 @@
+# A more reliable version of redis_dryer.py (see Queues across Networks in
+# concurrency.py). There, a dryer takes a dish off the list with blpop(): if
+# it crashes before it's done, that dish is gone. And DRYERS = 3 is fixed, no
+# matter how many dishes are waiting.
+
+# ReliableQueue does what the end of concurrency.py describes, with a list
+# for the dishes each dryer is working on:
+
+# – get() uses BLMOVE to move a dish from 'dishes' to that dryer's own
+#   in-flight list ('dishes:processing:<dryer>') in one atomic step, and
+#   notes the time in the 'dishes:taken' hash. Just before that, in the
+#   same round trip, it adds the dryer to the 'dishes:dryers' set, so the
+#   in-flight lists can be found without KEYS (which has to look at every
+#   key in the database, and holds up everyone else while it does).
+# – ack() removes it from the in-flight list once it's dried, and the dryer
+#   from the set. A dryer has one dish at a time: get(), then ack().
+# – requeue_expired() puts any dish that's been in flight for longer than
+#   visibility_timeout back at the front of 'dishes' for another dryer. A
+#   dryer that died (or hung) never acks, so its dishes come back.
+
+# This is "at least once": a dryer that was only slow, not dead, will finish
+# a dish that has already been handed to someone else, so a dish can be
+# dried twice but is never lost. ack() returns False when that happens.
+
+# Supervisor runs the dryers as processes and every interval seconds:
+# – requeues the dishes of any dryer process that has died, and any dish
+#   past its visibility timeout,
+# – works out how many dishes a dryer gets through per second, and starts or
+#   stops dryers so the backlog would be cleared in about target seconds
+#   (between min_dryers and max_dryers). Dryers are stopped with an Event
+#   they check between dishes, never in the middle of one.
+
+# Running this file starts a FakeRedis (fake_redis.py) so no Redis server is
+# needed.
+
+import math
+import multiprocessing
+import os
+import random
+import time
+import redis
+
+from fake_redis import FakeRedis
+
+
+class ReliableQueue():
+
+    def __init__(self, conn, name='dishes', visibility_timeout=30):
+        self.conn = conn
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.taken = name + ':taken'
+        self.done = name + ':done'
+        self.dryers = name + ':dryers'
+
+    def processing(self, dryer):
+        return '{}:processing:{}'.format(self.name, dryer)
+
+    def put(self, *items):
+        return self.conn.rpush(self.name, *items)
+
+    def get(self, dryer, timeout=1):
+        # Returns the next dish, or None after timeout seconds. If this
+        # process dies between the BLMOVE and the HSET, the dish has no time
+        # yet; requeue_expired() gives it one when it finds it.
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.sadd(self.dryers, dryer)
+        pipe.blmove(self.name, self.processing(dryer), timeout, 'LEFT',
+                    'RIGHT')
+        _, item = pipe.execute()
+        if item is not None:
+            self.conn.hset(self.taken, dryer, time.time())
+        return item
+
+    def ack(self, dryer, item):
+        pipe = self.conn.pipeline()
+        pipe.lrem(self.processing(dryer), 1, item)
+        pipe.hdel(self.taken, dryer)
+        pipe.srem(self.dryers, dryer)
+        removed, _, _ = pipe.execute()
+        if removed:
+            # a late ack, for a dish that's been requeued, isn't counted:
+            # whoever dries it next will be
+            self.conn.incr(self.done)
+        return bool(removed)
+
+    def backlog(self):
+        return self.conn.llen(self.name)
+
+    def _in_flight(self):
+        # (dryer, dishes in flight, time taken) for each dryer in the set
+        dryers = [d.decode('utf-8') for d in self.conn.smembers(self.dryers)]
+        pipe = self.conn.pipeline(transaction=False)
+        for dryer in dryers:
+            pipe.llen(self.processing(dryer))
+            pipe.hget(self.taken, dryer)
+        replies = pipe.execute()
+        return zip(dryers, replies[::2], replies[1::2])
+
+    def in_flight(self):
+        return sum(size for dryer, size, taken in self._in_flight())
+
+    def requeue(self, dryer):
+        # everything dryer had in flight goes back to the front of the queue
+        count = 0
+        while self.conn.lmove(self.processing(dryer), self.name,
+                              'RIGHT', 'LEFT') is not None:
+            count += 1
+        self.conn.hdel(self.taken, dryer)
+        self.conn.srem(self.dryers, dryer)
+        return count
+
+    def requeue_expired(self):
+        now = time.time()
+        count = 0
+        for dryer, size, taken in self._in_flight():
+            if not size:
+                continue  # waiting in get(), so it has to stay in the set
+            if taken is None:
+                self.conn.hset(self.taken, dryer, now)
+            elif now - float(taken) > self.visibility_timeout:
+                count += self.requeue(dryer)
+        return count
+
+
+# The dryer
+# -----------------------------------------------------------------------------
+# crash is the chance of the process dying part way through a dish, to show
+# that no dish is lost when that happens. Each dish that's dried is added to
+# the 'dishes:dried' list so we can check at the end.
+
+def dryer(port, name, stop, seconds, crash=0.0, visibility_timeout=30):
+    conn = redis.Redis(port=port)
+    queue = ReliableQueue(conn, name, visibility_timeout)
+    me = str(os.getpid())
+    while not stop.is_set():
+        dish = queue.get(me, timeout=0.5)
+        if dish is None:
+            continue
+        time.sleep(seconds)
+        if random.random() < crash:
+            os._exit(1)  # no cleanup at all, like a real crash
+        conn.rpush(name + ':dried', dish)
+        queue.ack(me, dish)
+
+
+# The supervisor
+# -----------------------------------------------------------------------------
+
+class Supervisor():
+
+    def __init__(self, port, name='dishes', min_dryers=1, max_dryers=8,
+                 target=2.0, interval=0.5, visibility_timeout=5,
+                 seconds=0.02, crash=0.0):
+        self.port = port
+        self.name = name
+        self.min_dryers = min_dryers
+        self.max_dryers = max_dryers
+        self.target = target
+        self.interval = interval
+        self.seconds = seconds
+        self.crash = crash
+        self.queue = ReliableQueue(redis.Redis(port=port), name,
+                                   visibility_timeout)
+        self.dryers = {}  # process -> its stop Event
+        self.crashed = 0
+        self.requeued = 0
+        self._done = int(self.queue.conn.get(self.queue.done) or 0)
+        self._checked = time.perf_counter()
+
+    def start_dryer(self):
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=dryer, args=(self.port, self.name, stop, self.seconds,
+                                self.crash, self.queue.visibility_timeout))
+        process.start()
+        self.dryers[process] = stop
+
+    def stop_dryer(self):
+        # the newest one; it finishes the dish it's on and exits
+        process = list(self.dryers)[-1]
+        self.dryers.pop(process).set()
+        process.join()
+
+    def check(self):
+        # the dishes of any dryer that died go straight back, without
+        # waiting for the visibility timeout
+        for process in [p for p in self.dryers if not p.is_alive()]:
+            del self.dryers[process]
+            process.join()
+            self.crashed += 1
+            self.requeued += self.queue.requeue(str(process.pid))
+        self.requeued += self.queue.requeue_expired()
+
+        now = time.perf_counter()
+        done = int(self.queue.conn.get(self.queue.done) or 0)
+        rate = (done - self._done) / (now - self._checked)
+        self._done, self._checked = done, now
+        backlog = self.queue.backlog()
+
+        # dishes per second one dryer manages; until there's a measurement,
+        # assume one dryer can clear the backlog in target seconds
+        per_dryer = rate / len(self.dryers) if self.dryers and rate else 0
+        if backlog and per_dryer:
+            wanted = math.ceil(backlog / (per_dryer * self.target))
+        elif backlog:
+            wanted = len(self.dryers) + 1
+        else:
+            wanted = self.min_dryers
+        wanted = max(self.min_dryers, min(self.max_dryers, wanted))
+        while len(self.dryers) < wanted:
+            self.start_dryer()
+        while len(self.dryers) > wanted:
+            self.stop_dryer()
+        return backlog, rate, len(self.dryers)
+
+    def run(self, verbose=True):
+        # until every dish has been dried and acked
+        start = time.perf_counter()
+        while True:
+            backlog, rate, dryers = self.check()
+            if verbose:
+                print('{:>5.1f}s  backlog {:>4}  {:>5.0f} dishes/sec  '
+                      '{} dryers'.format(time.perf_counter() - start,
+                                         backlog, rate, dryers))
+            if not backlog and not self.queue.in_flight():
+                break
+            time.sleep(self.interval)
+
+    def stop(self):
+        while self.dryers:
+            self.stop_dryer()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# 1000 dishes, 20ms each, and every dryer has a 1 in 200 chance of crashing
+# on each dish. The supervisor adds dryers while the backlog is big, drops
+# them as it shrinks and replaces the ones that crash. At the end every
+# dish must have been dried at least once.
+
+if __name__ == '__main__':
+    with FakeRedis() as server:
+        conn = redis.Redis(port=server.port)
+        dishes = ['dish{}'.format(i) for i in range(1000)]
+        ReliableQueue(conn).put(*dishes)
+
+        supervisor = Supervisor(server.port, max_dryers=8, crash=0.005)
+        supervisor.run()
+        supervisor.stop()
+
+        dried = [d.decode('utf-8') for d in conn.lrange('dishes:dried', 0, -1)]
+        print('dishes: {}, dried: {}, missing: {}, dried twice: {}'.format(
+            len(dishes), len(set(dried)), len(set(dishes) - set(dried)),
+            len(dried) - len(set(dried))))
+        print('dryers crashed: {}, dishes requeued: {}'.format(
+            supervisor.crashed, supervisor.requeued))
+
+        # A dryer that hangs rather than dies: its process is still alive so
+        # only the visibility timeout gets the dish back.
+        conn.flushdb()
+        queue = ReliableQueue(conn, visibility_timeout=0.5)
+        queue.put('plate')
+        print('slow dryer took', queue.get('slow'))
+        print('requeued:', queue.requeue_expired())
+        time.sleep(0.6)
+        print('requeued after the timeout:', queue.requeue_expired())
+        print('fast dryer took', queue.get('fast'))
+        print('fast ack:', queue.ack('fast', 'plate'))
+        print('slow ack:', queue.ack('slow', 'plate'))
+        print('counted as done:', int(conn.get(queue.done)))
+
+#   0.0s  backlog 1000      0 dishes/sec  1 dryers
+#   0.6s  backlog  977     43 dishes/sec  8 dryers
+#   1.1s  backlog  813    276 dishes/sec  8 dryers
+#   1.6s  backlog  676    271 dishes/sec  8 dryers
+#   2.1s  backlog  532    283 dishes/sec  7 dryers
+#   2.6s  backlog  413    241 dishes/sec  5 dryers
+#   3.1s  backlog  320    187 dishes/sec  4 dryers
+#   3.6s  backlog  235    170 dishes/sec  3 dryers
+#   4.2s  backlog  169    127 dishes/sec  2 dryers
+#   4.7s  backlog  123     89 dishes/sec  2 dryers
+#   5.2s  backlog   79     88 dishes/sec  1 dryers
+#   5.7s  backlog   55     49 dishes/sec  1 dryers
+#   6.2s  backlog   32     46 dishes/sec  1 dryers
+#   6.7s  backlog    9     46 dishes/sec  1 dryers
+#   7.2s  backlog    0     20 dishes/sec  1 dryers
+# dishes: 1000, dried: 1000, missing: 0, dried twice: 0
+# dryers crashed: 6, dishes requeued: 6
+# slow dryer took b'plate'
+# requeued: 0
+# requeued after the timeout: 1
+# fast dryer took b'plate'
+# fast ack: True
+# slow ack: False
+# counted as done: 1
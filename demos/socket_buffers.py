@@ -0,0 +1,253 @@
+# Receiving without making new bytes objects. tcp_server.py and
+# udp_server.py call recv(max_size) / recvfrom(max_size), and each call
+# allocates a new bytes object of max_size, copies what arrived into it and
+# shrinks it to fit. Add framing (see tcp_async_server.py) on top of that
+# and every message gets copied again, out of what was received, with
+# whatever's left over copied along to the next recv().
+
+# recv_into() and recvfrom_into() do the same but write what arrives into a
+# buffer you already have (a bytearray, or a memoryview of one) and return
+# how many bytes that was. A memoryview slice of the buffer is a window onto
+# those bytes, not a copy of them, so:
+
+# – FrameReader reads a TCP stream of length-prefixed messages into one
+#   bytearray and yields each message as a memoryview of that buffer. The
+#   only bytes ever copied are the start of a message that's split across
+#   two recv_into() calls, moved to the front of the buffer to make room.
+# – BufferPool is a set of bytearrays made once and handed out again and
+#   again. datagrams_into() receives each datagram into one of them.
+
+# The catch is that a memoryview of a buffer is only good until the buffer
+# is used again: FrameReader's messages until the next one is read,
+# datagrams_into()'s until the next datagram. Anything that needs to keep a
+# message longer has to copy it, bytes(message). memoryviews have most of
+# the methods of bytes (and struct.unpack_from, int.from_bytes, etc. take
+# them) but not all: no .split(), .startswith() and so on.
+
+import collections
+import multiprocessing
+import socket
+import time
+import tracemalloc
+
+from tcp_async_server import HEADER
+
+
+class BufferPool():
+
+    def __init__(self, count=64, size=4096):
+        self.size = size
+        self._free = collections.deque(memoryview(bytearray(size))
+                                       for _ in range(count))
+        self.misses = 0  # times one had to be made because none were free
+
+    def get(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            self.misses += 1
+            return memoryview(bytearray(self.size))
+
+    def put(self, buffer):
+        self._free.append(buffer)
+
+    def __len__(self):
+        return len(self._free)
+
+
+class FrameReader():
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.start = 0  # where the next message starts
+        self.end = 0  # where the bytes received so far end
+
+    def __iter__(self):
+        # yields a memoryview for each message until the other end closes
+        view = memoryview(self.buffer)
+        while True:
+            while self.end - self.start >= HEADER.size:
+                size, = HEADER.unpack_from(self.buffer, self.start)
+                stop = self.start + HEADER.size + size
+                if stop > self.end:
+                    break
+                yield view[self.start + HEADER.size:stop]
+                self.start = stop
+
+            # move what's left of a message to the front, and if that
+            # message won't fit in the buffer at all, make a bigger one
+            left = self.end - self.start
+            if self.start:
+                view[:left] = view[self.start:self.end]
+                self.start, self.end = 0, left
+            if self.end == len(self.buffer):
+                bigger = bytearray(len(self.buffer) * 2)
+                bigger[:left] = view[:left]
+                self.buffer, view = bigger, memoryview(bigger)
+
+            received = self.sock.recv_into(view[self.end:])
+            if not received:
+                return
+            self.end += received
+
+
+def datagrams_into(sock, pool):
+    # yields (memoryview, address) for each datagram until an empty one
+    while True:
+        buffer = pool.get()
+        try:
+            received, client = sock.recvfrom_into(buffer)
+            if not received:
+                return
+            yield buffer[:received], client
+        finally:
+            pool.put(buffer)
+
+
+# What the current code does
+# -----------------------------------------------------------------------------
+# recv() / recvfrom() with a new bytes object each time, and framing by
+# slicing bytes.
+
+def frames(sock, max_size=1000):
+    received = b''
+    while True:
+        data = sock.recv(max_size)
+        if not data:
+            return
+        received += data
+        while len(received) >= HEADER.size:
+            size, = HEADER.unpack_from(received)
+            stop = HEADER.size + size
+            if stop > len(received):
+                break
+            yield received[HEADER.size:stop]
+            received = received[stop:]
+
+
+def datagrams(sock, max_size=4096):
+    while True:
+        data, client = sock.recvfrom(max_size)
+        if not data:
+            return
+        yield data, client
+
+
+# Benchmark
+# -----------------------------------------------------------------------------
+# A sender process writes count messages of size bytes into one end of a
+# socketpair() and the receivers above read them from the other end. The
+# datagram test uses an AF_UNIX datagram socketpair rather than UDP: the
+# receiving code is the same, but the sender waits when the receiver falls
+# behind instead of the datagrams being dropped, so they all get counted.
+
+# Bytes allocated per message uses tracemalloc: the peak memory while
+# getting each message, over what was in use before it. It's slow, so it's
+# measured on its own, over fewer messages.
+
+def _send_stream(sock, count, size):
+    message = HEADER.pack(size) + b'x' * size
+    sock.sendall(message * count)
+    sock.close()
+
+
+def _send_datagrams(sock, count, size):
+    message = b'x' * size
+    for _ in range(count):
+        sock.send(message)
+    sock.send(b'')
+    sock.close()
+
+
+def _open(kind, count, size):
+    if kind == 'stream':
+        receiver, sender = socket.socketpair()
+        target = _send_stream
+    else:
+        receiver, sender = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_DGRAM)
+        target = _send_datagrams
+    process = multiprocessing.Process(target=target,
+                                      args=(sender, count, size))
+    process.start()
+    sender.close()
+    return receiver, process
+
+
+def throughput(kind, receive, count=200000, size=100):
+    sock, process = _open(kind, count, size)
+    start = time.perf_counter()
+    received = sum(1 for message in receive(sock))
+    elapsed = time.perf_counter() - start
+    process.join()
+    sock.close()
+    assert received == count, received
+    return count / elapsed
+
+
+def allocated(kind, receive, count=20000, size=100):
+    sock, process = _open(kind, count, size)
+    messages = iter(receive(sock))
+    total = 0
+    tracemalloc.start()
+    for _ in range(count):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        message = next(messages)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    del message
+    for message in messages:
+        pass
+    process.join()
+    sock.close()
+    return total / count
+
+
+def benchmark():
+    pool = BufferPool()
+    receivers = [
+        ('stream', 'recv(1000)', lambda sock: frames(sock, 1000)),
+        ('stream', 'recv(65536)', lambda sock: frames(sock, 65536)),
+        ('stream', 'recv_into', lambda sock: FrameReader(sock, 65536)),
+        ('datagram', 'recvfrom(4096)', lambda sock: datagrams(sock, 4096)),
+        ('datagram', 'recvfrom_into', lambda sock: datagrams_into(sock,
+                                                                  pool)),
+    ]
+    print('-' * 61)
+    print('100 byte messages')
+    print('{:<26}{:>16}{:>19}'.format('', 'messages/sec', 'bytes allocated'))
+    for kind, name, receive in receivers:
+        print('{:<26}{:>16.0f}{:>19.0f}'.format(
+            '{}, {}:'.format(kind, name), throughput(kind, receive),
+            allocated(kind, receive)))
+    print('buffer pool misses:', pool.misses)
+
+
+if __name__ == '__main__':
+    benchmark()
+
+# -------------------------------------------------------------
+# 100 byte messages
+#                               messages/sec    bytes allocated
+# stream, recv(1000):                 856849                628
+# stream, recv(65536):                469362              32652
+# stream, recv_into:                 1020312                216
+# datagram, recvfrom(4096):           357252               4129
+# datagram, recvfrom_into:            314387                184
+# buffer pool misses: 0
+
+# Streams: recv(1000) allocates a new 1000 byte object for every ten or so
+# messages, then each message is copied out of it and the rest copied
+# again. Making max_size bigger to save on system calls makes that worse,
+# not better: now the rest that's copied after each message is up to 64K.
+# recv_into() gets the big buffer without the copies. What's left of the
+# 216 bytes is the memoryview object itself and the generator's bits.
+
+# Datagrams: each one is a system call either way, and here the sender (a
+# send() per datagram, sharing one CPU with the receiver) sets the pace, so
+# messages/sec is mostly noise between runs. What recvfrom_into() saves is
+# the 4K allocation for every datagram, which is garbage to be cleaned up
+# and memory churn that adds up with many clients. udp_ingest_server.py
+# builds on this.
@@ -0,0 +1,145 @@
+# A version of tcp_server.py that keeps going. tcp_server.py accepts one
+# client, reads once with recv(max_size) and exits. That has three problems
+# for real traffic:
+
+# – one client, then it's done. Here asyncio.start_server() calls handle()
+#   as a task of its own for every connection, so one process can have
+#   thousands of them open at once while they mostly wait on the network.
+# – TCP is a stream, not messages: recv(1000) returns whatever has arrived,
+#   which can be part of a message, or the end of one and the start of the
+#   next, and anything past max_size is left for a recv() that never comes.
+#   Here every message is sent with its length in front of it (4 bytes, see
+#   HEADER), so the reader knows exactly how much to wait for.
+#   readexactly() waits for that many bytes however they arrive. max_size
+#   is now the biggest message allowed, not how much is read.
+# – nothing stops a client that connects and says nothing from holding on
+#   to its connection forever. Here a connection that's idle for
+#   idle_timeout seconds is closed.
+
+# Shutting down (Ctrl-C, or SIGTERM) is graceful: the server stops
+# accepting, closes the connections that are waiting for a message, and
+# gives the ones that are part way through a message up to grace seconds to
+# send their reply before they're cancelled.
+
+# Each message gets itself sent back (it's an echo server), framed the same
+# way. tcp_load_client.py talks to it.
+
+import asyncio
+import datetime
+import signal
+import struct
+
+
+address = ('localhost', 4544)
+max_size = 1000000  # bytes, the biggest message allowed
+HEADER = struct.Struct('!I')  # message length, 4 bytes, network byte order
+
+
+async def read_message(reader):
+    # raises IncompleteReadError if the connection closes between messages
+    header = await reader.readexactly(HEADER.size)
+    size, = HEADER.unpack(header)
+    if size > max_size:
+        raise ValueError('message of {} bytes is too big'.format(size))
+    return await reader.readexactly(size)
+
+
+def write_message(writer, data):
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+class Server():
+
+    def __init__(self, address=address, idle_timeout=30, grace=5,
+                 backlog=1024):
+        self.address = address
+        self.idle_timeout = idle_timeout
+        self.grace = grace
+        self.backlog = backlog  # tcp_server.py's listen(5)
+        self.server = None
+        self.connections = set()  # tasks, one for each connection
+        self.idle = set()  # the ones waiting for a message
+        self.closing = False
+        self.accepted = 0
+        self.messages = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def start(self):
+        host, port = self.address
+        self.server = await asyncio.start_server(self.handle, host, port,
+                                                 backlog=self.backlog)
+        # with port 0 the OS picks one
+        self.address = self.server.sockets[0].getsockname()[:2]
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        self.accepted += 1
+        try:
+            while not self.closing:
+                self.idle.add(task)
+                try:
+                    header = await asyncio.wait_for(
+                        reader.readexactly(HEADER.size), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    break
+                self.idle.discard(task)
+                size, = HEADER.unpack(header)
+                if size > max_size:
+                    self.errors += 1
+                    break
+                data = await asyncio.wait_for(reader.readexactly(size),
+                                              self.idle_timeout)
+                write_message(writer, data)
+                await writer.drain()
+                self.messages += 1
+        except asyncio.IncompleteReadError:
+            pass  # the client closed the connection
+        except (ConnectionError, asyncio.TimeoutError):
+            self.errors += 1
+        finally:
+            self.idle.discard(task)
+            self.connections.discard(task)
+            writer.close()
+
+    async def shutdown(self):
+        self.closing = True
+        self.server.close()
+        for task in self.idle:
+            task.cancel()
+        busy = set(self.connections)
+        if busy:
+            done, pending = await asyncio.wait(busy, timeout=self.grace)
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(busy)
+        await self.server.wait_closed()
+
+    def __str__(self):
+        return ('{} connections, {} open, {} messages, {} idle timeouts, '
+                '{} errors'.format(self.accepted, len(self.connections),
+                                   self.messages, self.timeouts,
+                                   self.errors))
+
+
+async def main():
+    server = Server()
+    await server.start()
+    print('Starting the server at', datetime.datetime.now())
+    print('waiting for clients to call on', server.address)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    print('Shutting down at', datetime.datetime.now())
+    await server.shutdown()
+    print(server)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
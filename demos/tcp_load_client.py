@@ -0,0 +1,135 @@
+# A load generator for tcp_async_server.py, based on tcp_client.py. Where
+# tcp_client.py connects, sends one message and reads one reply, each
+# client() here does that messages times over one connection, using the
+# same length-prefixed framing as the server. load() runs connections of
+# them, at most concurrency at a time, and reports:
+
+# – connections/sec: connections opened, used and closed per second
+# – the p50 and p99 latency of a message: from sending it to having the
+#   whole reply back
+# – the p99 time to connect, which is where a server that can't keep up
+#   with accepting shows first.
+
+# Run on its own it starts a Server in the same event loop (on a port the
+# OS picks) so there's nothing else to start. To load a server that's
+# already running: asyncio.run(load(address, ...)).
+
+import asyncio
+import datetime
+import time
+
+from tcp_async_server import HEADER, Server, address, read_message, \
+    write_message
+
+
+async def client(address, messages, size, timings):
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(*address)
+    timings['connect'].append(time.perf_counter() - start)
+    message = b'x' * size
+    try:
+        for _ in range(messages):
+            sent = time.perf_counter()
+            write_message(writer, message)
+            await writer.drain()
+            data = await read_message(reader)
+            timings['message'].append(time.perf_counter() - sent)
+            assert data == message
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def load(address=address, connections=1000, concurrency=100,
+               messages=10, size=100):
+    timings = {'connect': [], 'message': []}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            await client(address, messages, size, timings)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited() for _ in range(connections)),
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = sum(isinstance(r, Exception) for r in results)
+    return {'connections_per_sec': (connections - failed) / elapsed,
+            'failed': failed,
+            'p50': percentile(timings['message'], 50) * 1000,
+            'p99': percentile(timings['message'], 99) * 1000,
+            'connect_p99': percentile(timings['connect'], 99) * 1000}
+
+
+async def benchmark(connections=2000, messages=10, size=100):
+    server = Server(('localhost', 0), idle_timeout=2)
+    await server.start()
+    print('Starting the client at', datetime.datetime.now())
+    print('-' * 70)
+    print('{} connections, {} messages of {} bytes each'.format(
+        connections, messages, size))
+    print('{:<14}{:>12}{:>8}{:>10}{:>10}{:>16}'.format(
+        'concurrency', 'conns/sec', 'failed', 'p50 ms', 'p99 ms',
+        'connect p99 ms'))
+    for concurrency in (1, 100, 1000, 2000):
+        result = await load(server.address, connections, concurrency,
+                            messages, size)
+        print('{:<14}{connections_per_sec:>12.0f}{failed:>8}{p50:>10.2f}'
+              '{p99:>10.2f}{connect_p99:>16.2f}'.format(concurrency,
+                                                        **result))
+
+    # messages much bigger than tcp_server.py's max_size of 1000
+    result = await load(server.address, 10, 10, 1, 500000)
+    print('500000 byte messages: p50 {p50:.2f} ms, failed {failed}'.format(
+        **result))
+
+    # a client that connects and says nothing is closed after idle_timeout
+    reader, writer = await asyncio.open_connection(*server.address)
+    start = time.perf_counter()
+    await reader.read()
+    print('idle connection closed after {:.1f} sec'.format(
+        time.perf_counter() - start))
+    writer.close()
+
+    # shutting down while a client is part way through a message: it still
+    # gets its reply
+    reader, writer = await asyncio.open_connection(*server.address)
+    writer.write(HEADER.pack(5) + b'Hi')
+    await writer.drain()
+    await asyncio.sleep(0.1)
+    shutdown = asyncio.create_task(server.shutdown())
+    await asyncio.sleep(0.5)
+    writer.write(b'!!!')
+    print('reply during shutdown:', await read_message(reader))
+    writer.close()
+    await shutdown
+    print(server)
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark())
+
+# Starting the client at 2026-10-18 06:35:25.318445
+# ----------------------------------------------------------------------
+# 2000 connections, 10 messages of 100 bytes each
+# concurrency      conns/sec  failed    p50 ms    p99 ms  connect p99 ms
+# 1                      457       0      0.10      0.31            4.80
+# 100                    686       0      7.63     30.81           81.62
+# 1000                   485       0    141.41    262.14          394.40
+# 2000                   497       0    263.44    535.52         1395.17
+# 500000 byte messages: p50 19.21 ms, failed 0
+# idle connection closed after 2.0 sec
+# reply during shutdown: b'Hi!!!'
+# 8012 connections, 0 open, 80011 messages, 1 idle timeouts, 0 errors
+
+# All 2000 connections at once are served without a failure, from one
+# thread. Here the clients and the server share one process on one CPU, so
+# past 100 or so at a time there's no more throughput to be had and more
+# concurrency only means each message waits longer for its turn: latency
+# grows with concurrency. The connect p99 climbing is the listen backlog
+# filling up faster than accept() empties it.
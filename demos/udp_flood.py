@@ -0,0 +1,140 @@
+# A datagram flood for udp_ingest_server.py, based on udp_client.py. Each
+# client process sends its datagrams with sendto() from a socket of its own
+# (so its own port, so its own token bucket) and doesn't wait for a reply.
+
+# Run on its own, it starts an IngestServer in another process on a port
+# the OS picks, then:
+# – one client sends as fast as it can, with no rate limit on the server,
+#   to see how many datagrams a second the server takes in and what's lost
+# – the same noisy client alongside three quiet ones that send rate
+#   datagrams a second, with the server limiting each client to limit a
+#   second. The quiet ones should get everything through.
+
+# 'lost' is sent minus received: datagrams the kernel dropped because the
+# socket's receive buffer was full. The server never saw those.
+
+import collections
+import multiprocessing
+import socket
+import threading
+import time
+
+from udp_ingest_server import IngestServer
+
+
+def handle(batch):
+    # stand-in for real work: look at every byte of every message
+    for message, client in batch:
+        sum(message)
+
+
+def serve(ready, stop, results, rate, burst):
+    per_client = collections.Counter()
+    lock = threading.Lock()
+
+    def counting(batch):
+        handle(batch)
+        with lock:
+            per_client.update(client[1] for message, client in batch)
+
+    server = IngestServer(counting, ('localhost', 0), rate=rate, burst=burst)
+    ready.put(server.address)
+    threading.Thread(target=lambda: (stop.wait(), server.stop())).start()
+    server.run()
+    results.put((server.stats(), dict(per_client)))
+
+
+def client(name, server_address, seconds, rate, size, sent):
+    # rate=None sends as fast as it can
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(server_address)
+    message = b'x' * size
+    count = 0
+    start = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if now - start > seconds:
+            break
+        if rate:
+            wait = start + count / rate - now
+            if wait > 0:
+                time.sleep(wait)
+        try:
+            sock.send(message)
+            count += 1
+        except OSError:
+            pass  # ENOBUFS and the like: the datagram didn't go
+    sent.put((name, sock.getsockname()[1], count))
+    sock.close()
+
+
+def flood(quiet=0, limit=None, rate=200, seconds=2, size=100):
+    ready, stop = multiprocessing.Queue(), multiprocessing.Event()
+    results, sent = multiprocessing.Queue(), multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(
+        ready, stop, results, limit, limit // 10 if limit else None))
+    server.start()
+    address = ready.get()
+
+    clients = [multiprocessing.Process(target=client, args=(
+        'noisy', address, seconds, None, size, sent))]
+    clients += [multiprocessing.Process(target=client, args=(
+        'quiet', address, seconds, rate, size, sent)) for _ in range(quiet)]
+    for c in clients:
+        c.start()
+    counts = sorted(sent.get() for c in clients)
+    for c in clients:
+        c.join()
+    time.sleep(0.5)  # for the workers to finish what's been received
+    stop.set()
+    stats, per_client = results.get()
+    server.join()
+
+    print('-' * 70)
+    print('1 noisy client{}, server limit {}'.format(
+        ', {} quiet at {}/sec'.format(quiet, rate) if quiet else '',
+        '{}/sec'.format(limit) if limit else 'none'))
+    total = sum(n for name, port, n in counts)
+    print('sent {}, lost {}, received {} ({:.0f}/sec)'.format(
+        total, total - stats['received'], stats['received'],
+        stats['received'] / seconds))
+    print('processed {} ({:.0f}/sec), rate limited {}, overflow {}'.format(
+        stats['processed'], stats['processed'] / seconds, stats['dropped'],
+        stats['overflow']))
+    for name, port, n in counts:
+        print('  {:<8} sent {:>7}  processed {:>7}'.format(
+            name, n, per_client.get(port, 0)))
+
+
+if __name__ == '__main__':
+    flood()
+    flood(quiet=3, limit=2000)
+
+# ----------------------------------------------------------------------
+# 1 noisy client, server limit none
+# sent 219813, lost 0, received 219813 (109906/sec)
+# processed 197291 (98646/sec), rate limited 0, overflow 22522
+#   noisy    sent  219813  processed  197291
+# ----------------------------------------------------------------------
+# 1 noisy client, 3 quiet at 200/sec, server limit 2000/sec
+# sent 311708, lost 61445, received 250263 (125132/sec)
+# processed 5241 (2620/sec), rate limited 245022, overflow 0
+#   noisy    sent  310505  processed    4265
+#   quiet    sent     401  processed     325
+#   quiet    sent     401  processed     323
+#   quiet    sent     401  processed     328
+
+# With no limit, the receiving loop keeps up with the flood (nothing lost
+# in the kernel) but the workers don't: about a tenth of it is dropped as
+# overflow rather than piling up in memory. Everything here shares one CPU,
+# the workers included.
+
+# With the limit, the noisy client gets its 2000 a second and the rest is
+# dropped as soon as it's read, so the workers have nothing to fall behind
+# on and the quiet clients' datagrams are all processed... once they reach
+# the server. The ones that are lost (about 1 in 5 here) were dropped by
+# the kernel when the socket's receive buffer was full, before the server
+# could see who they were from. A token bucket can only protect what comes
+# after the socket; to protect the socket, the receive buffer needs to be
+# bigger (SO_RCVBUF is capped by net.core.rmem_max on Linux) or the flood
+# stopped before it gets to this machine.
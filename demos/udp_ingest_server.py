@@ -0,0 +1,197 @@
+# A long-running version of udp_server.py. udp_server.py waits for one
+# datagram, replies and closes. IngestServer keeps taking datagrams in for
+# as long as it runs and hands them to handler(batch), where batch is a
+# list of (message, client) tuples, on a pool of worker threads:
+
+# – The socket is non-blocking and watched with a selector. When it's
+#   readable, run() drains it: recvfrom_into() (see socket_buffers.py) in a
+#   tight loop until there's nothing left, collecting batch_size datagrams
+#   at a time into buffers from a BufferPool. Nothing else happens on that
+#   thread, so the socket's receive buffer is emptied as fast as possible;
+#   when it fills, the kernel drops whatever else arrives. Each pass takes
+#   at most enough to fill the batch queue, then goes back to run() so
+#   stop() works even under a flood that never lets the socket empty.
+# – Each client (address and port) gets a token bucket: rate datagrams a
+#   second on average, with bursts of up to burst. A datagram from a client
+#   with no tokens left is dropped straight away, so one noisy client can't
+#   use up all the workers' time.
+# – Batches wait for the workers in a Queue of at most max_batches. If
+#   that's full the workers are behind and the whole batch is dropped
+#   rather than held on to: overflow counts those datagrams.
+
+# message is a memoryview of a buffer that goes back into the pool once
+# the handler returns: bytes(message) to keep it. stats() has the counters.
+# Unlike udp_server.py it doesn't reply, so udp_client.py would wait for
+# ever; udp_flood.py starts one of these and floods it.
+
+import collections
+import datetime
+import queue
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+from socket_buffers import BufferPool
+
+
+server_address = ('localhost', 4544)
+max_size = 4096
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class IngestServer():
+
+    def __init__(self, handler, address=server_address, workers=4,
+                 batch_size=64, rate=1000, burst=100, max_batches=16,
+                 receive_buffer=4 * 1024 * 1024):
+        # rate=None for no limit
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_drain = batch_size * max_batches  # datagrams per pass
+        self.rate = rate
+        self.burst = burst
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             receive_buffer)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.pool = BufferPool(batch_size * (max_batches + workers + 1),
+                               max_size)
+        self.batches = queue.Queue(max_batches)
+        self.buckets = {}  # client -> TokenBucket
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()  # for the workers' counts
+        self.closing = False
+        self.workers = [threading.Thread(target=self._work)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        pruned = time.monotonic()
+        try:
+            while not self.closing:
+                if selector.select(timeout=0.1):
+                    self._drain()
+                if time.monotonic() - pruned > 10:
+                    self._prune()
+                    pruned = time.monotonic()
+        finally:
+            selector.close()
+            self.sock.close()
+            for _ in self.workers:
+                self.batches.put(None)
+            for worker in self.workers:
+                worker.join()
+
+    def stop(self):
+        # from another thread; run() returns once the workers are done
+        self.closing = True
+
+    def _drain(self):
+        batch = []
+        for _ in range(self.max_drain):
+            buffer = self.pool.get()
+            try:
+                received, client = self.sock.recvfrom_into(buffer)
+            except BlockingIOError:
+                self.pool.put(buffer)
+                break
+            self.counts['received'] += 1
+            if self.rate is not None:
+                bucket = self.buckets.get(client)
+                if bucket is None:
+                    bucket = self.buckets[client] = TokenBucket(self.rate,
+                                                                self.burst)
+                if not bucket.take(time.monotonic()):
+                    self.counts['dropped'] += 1
+                    self.pool.put(buffer)
+                    continue
+            batch.append((buffer[:received], client, buffer))
+            if len(batch) == self.batch_size:
+                self._submit(batch)
+                batch = []
+        if batch:
+            self._submit(batch)
+
+    def _submit(self, batch):
+        try:
+            self.batches.put_nowait(batch)
+        except queue.Full:
+            self.counts['overflow'] += len(batch)
+            for message, client, buffer in batch:
+                self.pool.put(buffer)
+
+    def _work(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            try:
+                self.handler([(message, client)
+                              for message, client, buffer in batch])
+                outcome = 'processed'
+            except Exception:
+                traceback.print_exc()
+                outcome = 'errors'
+            finally:
+                for message, client, buffer in batch:
+                    self.pool.put(buffer)
+            with self._lock:
+                self.counts[outcome] += len(batch)
+
+    def _prune(self):
+        # forget clients that have been quiet long enough to have a full
+        # bucket again, or the dict grows with every client ever seen
+        now = time.monotonic()
+        for client, bucket in list(self.buckets.items()):
+            if now - bucket.updated > bucket.burst / bucket.rate:
+                del self.buckets[client]
+
+    def stats(self):
+        return {'received': self.counts['received'],
+                'processed': self.counts['processed'],
+                'dropped': self.counts['dropped'],
+                'overflow': self.counts['overflow'],
+                'errors': self.counts['errors'],
+                'clients': len(self.buckets),
+                'pool_misses': self.pool.misses}
+
+
+if __name__ == '__main__':
+
+    def show(batch):
+        for message, client in batch:
+            print('Message:', datetime.datetime.now(), client, 'said',
+                  bytes(message))
+
+    server = IngestServer(show)
+    print('Starting the server at', datetime.datetime.now())
+    print('waiting for clients on', server.address)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.stop()
+    print(server.stats())
@@ -0,0 +1,563 @@
+'''PostgreSQL Example 2'''
+
+
+# This is a reworked version of the inventory functions in
+# postgreSQL_example.py. Every function there opens a new connection, runs one
+# statement, commits and closes the connection again. Opening a connection is
+# by far the most expensive part of that: for PostgreSQL it's a network round
+# trip, authentication and a new server process; even for sqlite3 it means
+# opening the file and reading the schema. The query itself is tiny by
+# comparison.
+
+# Inventory below is a small data access object (DAO) for the inventory table
+# that:
+
+# – keeps its connections open and reuses them (a pool of them for
+#   PostgreSQL, one per thread for sqlite3),
+# – prepares each statement once per connection and reuses it,
+# – has insert_many() and update_many() for changing lots of rows in one
+#   transaction,
+# – has stream(), a version of display() that hands the table over in
+#   batches instead of building one enormous list,
+# – has load() and load_csv() for bulk imports (see Bulk loading below).
+
+# There are two versions with the same methods: Inventory uses sqlite3 and
+# PgInventory uses PostgreSQL through psycopg2. psycopg2 is only needed for
+# PgInventory, so the sqlite3 version (and the benchmarks, which use sqlite3)
+# work without it.
+
+import sqlite3
+import contextlib
+import csv
+import io
+import itertools
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+
+# sqlite3
+# -----------------------------------------------------------------------------
+# A sqlite3 connection can't be shared between threads, so each thread gets
+# its own connection the first time it needs one (threading.local) and keeps
+# it.
+
+# sqlite3 already prepares statements for us: each connection keeps a cache of
+# compiled statements keyed on the SQL text (cached_statements, 128 by default
+# since python 3.5). That only helps if the SQL text is exactly the same every
+# time, which is why the statements are kept in one dict and values are always
+# passed as parameters rather than formatted into the string.
+
+class Inventory():
+
+    # what a failed chunk in load() can raise
+    error = sqlite3.Error
+
+    statements = {
+        'create': '''CREATE TABLE IF NOT EXISTS inventory
+                     (item TEXT, quantity INT, cost FLOAT)''',
+        'insert': 'INSERT INTO inventory VALUES (?, ?, ?)',
+        'select': 'SELECT * FROM inventory',
+        'delete': 'DELETE FROM inventory WHERE item=?',
+        'update': 'UPDATE inventory SET quantity=?, cost=? WHERE item=?',
+    }
+
+    def __init__(self, path='data/test.db', cached_statements=128):
+        self.path = path
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path,
+                                   cached_statements=self.cached_statements,
+                                   check_same_thread=False)
+            self.local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def cursor(self):
+        # one transaction: commit if the block finishes, rollback if it raises
+        conn = self._connection()
+        curs = conn.cursor()
+        try:
+            yield curs
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            curs.close()
+
+    def _execute(self, curs, name, params=()):
+        curs.execute(self.statements[name], params)
+
+    def _execute_many(self, curs, name, rows):
+        curs.executemany(self.statements[name], rows)
+
+    def create(self):
+        with self.cursor() as curs:
+            self._execute(curs, 'create')
+
+    def insert(self, item, quantity, cost):
+        with self.cursor() as curs:
+            self._execute(curs, 'insert', (item, quantity, cost))
+
+    def insert_many(self, rows):
+        # rows is an iterable of (item, quantity, cost)
+        with self.cursor() as curs:
+            self._execute_many(curs, 'insert', rows)
+
+    def display(self):
+        with self.cursor() as curs:
+            self._execute(curs, 'select')
+            return curs.fetchall()
+
+    def stream(self, batch_size=1000):
+        # Generator version of display(): yields lists of up to batch_size
+        # rows. sqlite3 steps through the table as fetchmany() asks for rows,
+        # so only one batch is ever in memory, however big the table is.
+        curs = self._connection().cursor()
+        try:
+            curs.execute(self.statements['select'])
+            while True:
+                rows = curs.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            curs.close()
+
+    def delete(self, item):
+        with self.cursor() as curs:
+            self._execute(curs, 'delete', (item,))
+
+    def update(self, quantity, cost, item):
+        with self.cursor() as curs:
+            self._execute(curs, 'update', (quantity, cost, item))
+
+    def update_many(self, rows):
+        # rows is an iterable of (quantity, cost, item), same order as update()
+        with self.cursor() as curs:
+            self._execute_many(curs, 'update', rows)
+
+    def load(self, rows, chunk_size=10000):
+        # Bulk import. rows is any iterable of (item, quantity, cost), e.g. a
+        # generator or a csv.reader, and is only read chunk_size rows at a
+        # time. Each chunk is its own transaction, so a chunk that fails is
+        # rolled back and reported without undoing the chunks before it, and
+        # the load carries on with the next one.
+        loaded = 0
+        failed = []
+        rows = iter(rows)
+        start = time.perf_counter()
+        for number in itertools.count():
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            try:
+                with self.cursor() as curs:
+                    self._load_chunk(curs, chunk)
+            except self.error as e:
+                failed.append((number, len(chunk), e))
+            else:
+                loaded += len(chunk)
+        seconds = time.perf_counter() - start
+        return {'rows': loaded,
+                'failed': failed,
+                'seconds': seconds,
+                'rows_per_sec': loaded / seconds if seconds else 0.0}
+
+    def load_csv(self, path, chunk_size=10000, header=True):
+        # A file with item,quantity,cost lines. The values come out of the
+        # csv module as strings; the columns' types turn them back into
+        # numbers (sqlite3's type affinity or COPY's parsing).
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            if header:
+                next(reader, None)
+            return self.load(reader, chunk_size)
+
+    def _load_chunk(self, curs, chunk):
+        self._execute_many(curs, 'insert', chunk)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# PostgreSQL
+# -----------------------------------------------------------------------------
+# psycopg2 comes with connection pools. ThreadedConnectionPool can be shared
+# between threads: getconn() hands out a connection that isn't in use (opening
+# a new one if needed, up to maxconn) and putconn() gives it back for the next
+# caller instead of closing it.
+
+# psycopg2 doesn't prepare statements on its own; every execute() sends the
+# full SQL text and the server parses and plans it again. PostgreSQL's
+# PREPARE does that work once and EXECUTE then only sends the values.
+# Prepared statements belong to one connection (session), so we remember
+# which ones have been prepared on each connection. Note the $1, $2
+# placeholders: those are PostgreSQL's own, the %s ones are psycopg2's.
+
+# For the bulk methods, psycopg2.extras.execute_batch() joins many EXECUTEs
+# into one string and sends them page_size at a time, so 1000 rows take a
+# handful of round trips instead of 1000.
+
+class PgInventory(Inventory):
+
+    statements = {
+        'create': '''CREATE TABLE IF NOT EXISTS inventory
+                     (item TEXT, quantity INT, cost FLOAT)''',
+        'insert': 'INSERT INTO inventory VALUES ($1, $2, $3)',
+        'select': 'SELECT * FROM inventory',
+        'delete': 'DELETE FROM inventory WHERE item=$1',
+        'update': 'UPDATE inventory SET quantity=$1, cost=$2 WHERE item=$3',
+    }
+
+    # statements that can't or needn't be prepared
+    unprepared = {'create'}
+
+    def __init__(self, dsn, minconn=1, maxconn=10, page_size=100):
+        if psycopg2 is None:
+            raise ImportError('PgInventory needs psycopg2: '
+                              'pip install psycopg2-binary')
+        self.dsn = dsn
+        self.page_size = page_size
+        self.error = psycopg2.Error
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._prepared = {}  # connection -> set of prepared statement names
+
+    @contextlib.contextmanager
+    def cursor(self):
+        conn = self.pool.getconn()
+        curs = conn.cursor()
+        try:
+            yield curs
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # rather than guess which PREPAREs outlived the failed transaction,
+            # drop them all and prepare again as they're needed
+            if not conn.closed:
+                curs.execute('DEALLOCATE ALL')
+                conn.commit()
+            self._prepared.pop(conn, None)
+            raise
+        finally:
+            curs.close()
+            # a connection that was lost is thrown away, not reused
+            if conn.closed:
+                self._prepared.pop(conn, None)
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def _prepare(self, curs, name):
+        # returns the EXECUTE to run in place of the statement
+        sql = self.statements[name]
+        if name in self.unprepared:
+            return sql
+        count = sql.count('$')
+        # each connection is only used by one thread at a time (it's out of
+        # the pool), so its set needs no lock
+        prepared = self._prepared.setdefault(curs.connection, set())
+        if name not in prepared:
+            curs.execute('PREPARE inventory_{} AS {}'.format(name, sql))
+            prepared.add(name)
+        if count:
+            return 'EXECUTE inventory_{} ({})'.format(
+                name, ', '.join(['%s'] * count))
+        return 'EXECUTE inventory_{}'.format(name)
+
+    def _execute(self, curs, name, params=()):
+        curs.execute(self._prepare(curs, name), params)
+
+    def stream(self, batch_size=1000):
+        # A plain psycopg2 cursor copies the whole result to the client as
+        # soon as execute() returns, so fetchmany() alone doesn't help. A
+        # named cursor is a server-side cursor (DECLARE ... CURSOR): the
+        # result stays on the server and each fetchmany() brings over the
+        # next batch_size rows. It has to live inside a transaction, so the
+        # connection is kept out of the pool until the generator is finished
+        # or closed.
+        conn = self.pool.getconn()
+        curs = conn.cursor(name='inventory_stream')
+        try:
+            curs.execute(self.statements['select'])
+            while True:
+                rows = curs.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            curs.close()
+            if not conn.closed:
+                conn.rollback()  # nothing to commit, just end the transaction
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def _execute_many(self, curs, name, rows):
+        psycopg2.extras.execute_batch(curs, self._prepare(curs, name), rows,
+                                      page_size=self.page_size)
+
+    def _load_chunk(self, curs, chunk):
+        # COPY is PostgreSQL's bulk loader: the rows are sent as one stream
+        # of CSV text and the server inserts them without planning or
+        # executing a statement per row. It's many times faster than even
+        # execute_batch(). The chunk is turned into CSV in memory (None is
+        # written as an empty field, which COPY reads as NULL).
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        buffer.seek(0)
+        curs.copy_expert('COPY inventory (item, quantity, cost) '
+                         'FROM STDIN WITH (FORMAT csv)', buffer)
+
+    def close(self):
+        self.pool.closeall()
+        self._prepared.clear()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The same steps as at the bottom of postgreSQL_example.py. To use PostgreSQL
+# instead, swap in:
+# inventory = PgInventory("dbname='test1' user='postgres' "
+#                         "password='your-password' host='localhost' "
+#                         "port='5432'")
+
+if __name__ == '__main__':
+    with Inventory('data/test.db') as inventory:
+        inventory.create()
+        inventory.insert('Coffee', 25, 10.5)
+        inventory.insert_many([('Rocks', 5, 2), ('Dice', 100, 0.5)])
+        inventory.delete('Rocks')
+        inventory.update(100, 0.5, 'Dice')
+        inventory.update_many([(30, 11.0, 'Coffee'), (90, 0.5, 'Dice')])
+        print(inventory.display())
+        for batch in inventory.stream(batch_size=1):
+            print(batch)
+        # the second chunk has a row with a missing value and is skipped
+        stats = inventory.load([('Kites', 3, 12.0), ('Yo-yos', 40, 1.5),
+                                ('Hats', 7), ('Socks', 60, 4.0)],
+                               chunk_size=2)
+        print(stats['rows'], 'rows loaded, failed:', stats['failed'])
+        print([row[0] for row in inventory.display()])
+    os.remove('data/test.db')
+
+# [('Coffee', 30, 11.0), ('Dice', 90, 0.5)]
+# [('Coffee', 30, 11.0)]
+# [('Dice', 90, 0.5)]
+# 2 rows loaded, failed: [(1, 2, ProgrammingError('Incorrect number of
+# bindings supplied. The current statement uses 3, and there are 2
+# supplied.'))]
+# ['Coffee', 'Dice', 'Kites', 'Yo-yos']
+
+
+# Benchmark: open per call vs Inventory
+# -----------------------------------------------------------------------------
+# The open-per-call functions are the sqlite3 ones from postgreSQL_example.py
+# (copied here because importing that file would run its examples). Each
+# benchmark runs on its own file in a temporary directory.
+
+@contextlib.contextmanager
+def scratch_path():
+    with tempfile.TemporaryDirectory() as tmp:
+        yield os.path.join(tmp, 'inventory.db')
+
+
+def _per_call_insert(db, item, quantity, cost):
+    conn = sqlite3.connect(db)
+    curs = conn.cursor()
+    curs.execute('INSERT INTO inventory VALUES (?, ?, ? )',
+      (item, quantity, cost))
+    curs.connection.commit()
+    curs.close()
+    conn.close()
+
+
+def _per_call_update(db, quantity, cost, item):
+    conn = sqlite3.connect(db)
+    curs = conn.cursor()
+    curs.execute('UPDATE inventory SET quantity=?, cost=? WHERE item=?',
+      (quantity, cost, item))
+    curs.connection.commit()
+    curs.close()
+    conn.close()
+
+
+def benchmark(rows: int=2000):
+    data = [('item{}'.format(i), i % 100, i / 100) for i in range(rows)]
+    changes = [(q + 1, c * 2, item) for item, q, c in data]
+    results = []
+
+    with scratch_path() as db:
+        with Inventory(db) as inventory:
+            inventory.create()
+        start = time.perf_counter()
+        for row in data:
+            _per_call_insert(db, *row)
+        for row in changes:
+            _per_call_update(db, *row)
+        results.append(time.perf_counter() - start)
+
+    with scratch_path() as db, Inventory(db) as inventory:
+        inventory.create()
+        start = time.perf_counter()
+        for row in data:
+            inventory.insert(*row)
+        for row in changes:
+            inventory.update(*row)
+        results.append(time.perf_counter() - start)
+
+    with scratch_path() as db, Inventory(db) as inventory:
+        inventory.create()
+        start = time.perf_counter()
+        inventory.insert_many(data)
+        inventory.update_many(changes)
+        results.append(time.perf_counter() - start)
+
+    print('-' * 50)
+    print('{} inserts + {} updates'.format(rows, rows))
+    print('open per call:          {:>8.2f} sec'.format(results[0]))
+    print('Inventory, per row:     {:>8.2f} sec'.format(results[1]))
+    print('Inventory, *_many():    {:>8.2f} sec'.format(results[2]))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+# --------------------------------------------------
+# 2000 inserts + 2000 updates
+# open per call:              4.16 sec
+# Inventory, per row:         2.81 sec
+# Inventory, *_many():        0.29 sec
+
+# Keeping the connection open saves about a third here. With sqlite3 the rest
+# of the per row time is mostly the commit (see sqlite3_example3.py), which is
+# why the *_many() versions, with one commit for all of them, are so much
+# faster. With PostgreSQL over a network the connection is a much bigger
+# share of the cost, so the gap between the first two is bigger too.
+
+
+# Benchmark: display() vs stream() memory
+# -----------------------------------------------------------------------------
+# tracemalloc records the peak memory python allocated while reading the whole
+# table. display() has to hold every row at once so its peak grows with the
+# table; stream() only ever holds one batch.
+
+def _peak(read):
+    tracemalloc.start()
+    start = time.perf_counter()
+    read()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20, elapsed
+
+
+def benchmark_stream(sizes=(100000, 400000), batch_size: int=1000):
+    print('-' * 50)
+    print('{:>8} {:>20} {:>20}'.format('rows', 'display() MB / sec',
+                                      'stream() MB / sec'))
+    for size in sizes:
+        with scratch_path() as db, Inventory(db) as inventory:
+            inventory.create()
+            inventory.insert_many(('item{}'.format(i), i % 100, i / 100)
+                                  for i in range(size))
+
+            def everything():
+                return len(inventory.display())
+
+            def batches():
+                return sum(len(b) for b in inventory.stream(batch_size))
+
+            whole = _peak(everything)
+            streamed = _peak(batches)
+        print('{:>8} {:>12.1f} / {:<5.2f} {:>12.1f} / {:.2f}'.format(
+            size, *whole, *streamed))
+
+
+if __name__ == '__main__':
+    benchmark_stream()
+
+# --------------------------------------------------
+#     rows   display() MB / sec    stream() MB / sec
+#   100000         14.7 / 0.52           0.2 / 0.39
+#   400000         59.0 / 2.53           0.2 / 1.46
+
+# (times are with tracemalloc running, which slows everything down)
+# stream()'s peak stays at about 0.2 MB however many rows there are. It's a
+# bit quicker too, since python never has to build and grow the big list.
+
+
+# Benchmark: nightly import, insert() per row vs load()
+# -----------------------------------------------------------------------------
+# The import as it is now calls insert() once per row: a connection, a
+# round trip and a commit for every row. load() and load_csv() are run on a
+# lot more rows since they'd be over too quickly to time otherwise; compare
+# the rows/sec.
+
+def benchmark_load(per_row: int=2000, bulk: int=500000,
+                   chunk_size: int=10000):
+    def rows(count):
+        return (('item{}'.format(i), i % 100, i / 100) for i in range(count))
+
+    results = []
+    with scratch_path() as db, Inventory(db) as inventory:
+        inventory.create()
+        start = time.perf_counter()
+        for row in rows(per_row):
+            _per_call_insert(db, *row)
+        results.append(per_row / (time.perf_counter() - start))
+
+    with scratch_path() as db, Inventory(db) as inventory:
+        inventory.create()
+        results.append(inventory.load(rows(bulk), chunk_size)['rows_per_sec'])
+
+    with scratch_path() as db, Inventory(db) as inventory:
+        path = os.path.join(os.path.dirname(db), 'inventory.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['item', 'quantity', 'cost'])
+            writer.writerows(rows(bulk))
+        inventory.create()
+        results.append(inventory.load_csv(path, chunk_size)['rows_per_sec'])
+
+    print('-' * 50)
+    print('insert() per row:       {:>10.0f} rows/sec'.format(results[0]))
+    print('load(), {:>6} chunks:  {:>10.0f} rows/sec'.format(chunk_size,
+                                                            results[1]))
+    print('load_csv():             {:>10.0f} rows/sec'.format(results[2]))
+
+
+if __name__ == '__main__':
+    benchmark_load()
+
+# --------------------------------------------------
+# insert() per row:             1168 rows/sec
+# load(),  10000 chunks:      350390 rows/sec
+# load_csv():                 312331 rows/sec
+
+# With PostgreSQL, PgInventory.load() uses COPY, and the difference is bigger
+# still since every per row insert is also a network round trip.
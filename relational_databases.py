@@ -772,6 +772,9 @@ session.add_all([second, third])
 
 session.commit()
 
+# NOTE: add() and add_all() are fine for a few objects but slow for loading
+# lots of rows. See sqlalchemy_example.py for bulk inserts and upserts.
+
 # You can use sqlite in the command line to check it:
 # $ sqlite3 inventory2.db
 # .tables
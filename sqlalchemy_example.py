@@ -0,0 +1,598 @@
+'''SQLAlchemy Example'''
+
+
+# This picks up the inventory example from the SQLAlchemy sections of
+# relational_databases.py and looks at what happens with a lot more rows.
+# It's written for SQLAlchemy 1.4 or later (the 2.0 style API), where the
+# examples in relational_databases.py are the older 1.x style.
+
+# Adding objects with session.add() / add_all() goes through the ORM's
+# unit of work: for every object the session keeps an identity map entry,
+# tracks its state, works out at flush time what SQL it needs and then
+# refreshes it. That's great for a handful of objects you're going to keep
+# working with, and a lot of overhead for 100,000 rows you're only loading.
+
+# Bulk persistence skips the objects altogether:
+# – bulk_insert() sends plain rows straight to a Core insert() in chunks.
+#   Given a list of parameter sets, execute() uses the driver's
+#   executemany() (or, in 2.0, multi-row INSERT ... VALUES batches).
+# – upsert() inserts rows or, where a row with the same things (the primary
+#   key) already exists, updates its count and cost.
+
+# The same goes for reading: conn.execute(inventory.select()).fetchall()
+# builds a list of every row. stream_rows() and stream_objects() hand them
+# over in fixed-size chunks instead (see Streaming results).
+
+# Finally, QueryCache saves running the same select over and over when the
+# table hasn't changed (see Result cache).
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session, declarative_base
+import collections
+import itertools
+import re
+import threading
+import time
+import tracemalloc
+
+
+# The model
+# -----------------------------------------------------------------------------
+# The same Inventory class as the ORM section of relational_databases.py.
+# Inventory.__table__ is the Table object the ORM made for it, i.e. the same
+# thing as the Expression Language's inventory table, so Core statements and
+# the ORM work on the one table.
+
+Base = declarative_base()
+
+
+class Inventory(Base):
+    __tablename__ = 'inventory'
+    things = sa.Column('things', sa.String, primary_key=True)
+    count = sa.Column('count', sa.Integer)
+    cost = sa.Column('cost', sa.Float)
+
+    def __init__(self, things, count, cost):
+        self.things = things
+        self.count = count
+        self.cost = cost
+
+    def __repr__(self):
+        return "<Inventory({}, {}, {})>".format(self.things, self.count,
+                                                self.cost)
+
+
+inventory = Inventory.__table__
+
+
+# Bulk insert and upsert
+# -----------------------------------------------------------------------------
+# rows is any iterable of (things, count, cost) tuples and is read chunk_size
+# rows at a time, so it can be a generator over a huge file. Each function
+# runs in one transaction (engine.begin() commits at the end or rolls back
+# everything if something goes wrong) and returns the number of rows.
+
+# For the upsert, SQLite (3.24+) and PostgreSQL both have
+# INSERT ... ON CONFLICT (things) DO UPDATE, which SQLAlchemy builds with its
+# dialect specific insert(). excluded is the row that couldn't be inserted.
+# Other databases get an UPDATE for the rows that already exist followed by
+# an INSERT for the rest.
+
+def _chunks(rows, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = [{'things': things, 'count': count, 'cost': cost}
+                 for things, count, cost in itertools.islice(rows, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_insert(engine, rows, chunk_size=10000):
+    total = 0
+    with engine.begin() as conn:
+        for chunk in _chunks(rows, chunk_size):
+            conn.execute(inventory.insert(), chunk)
+            total += len(chunk)
+    return total
+
+
+def _upsert_statement(dialect):
+    if dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    statement = insert(inventory)
+    return statement.on_conflict_do_update(
+        index_elements=[inventory.c.things],
+        set_={'count': statement.excluded['count'],
+              'cost': statement.excluded['cost']})
+
+
+def upsert(engine, rows, chunk_size=10000):
+    statement = _upsert_statement(engine.dialect)
+    update = (inventory.update()
+              .where(inventory.c.things == sa.bindparam('key'))
+              .values(count=sa.bindparam('count'), cost=sa.bindparam('cost')))
+    total = 0
+    with engine.begin() as conn:
+        for chunk in _chunks(rows, chunk_size):
+            total += len(chunk)
+            if statement is not None:
+                conn.execute(statement, chunk)
+                continue
+            keys = [row['things'] for row in chunk]
+            existing = set(conn.scalars(
+                sa.select(inventory.c.things)
+                .where(inventory.c.things.in_(keys))))
+            # bindparam names can't be column names in an UPDATE's WHERE
+            changed = [dict(row, key=row['things']) for row in chunk
+                       if row['things'] in existing]
+            new = [row for row in chunk if row['things'] not in existing]
+            if changed:
+                conn.execute(update, changed)
+            if new:
+                conn.execute(inventory.insert(), new)
+    return total
+
+
+# Streaming results
+# -----------------------------------------------------------------------------
+# Both are generators that yield lists of up to chunk_size rows.
+
+# stream_results=True asks the driver for a server-side cursor where it has
+# one (psycopg2's named cursors, for example); sqlite3 reads rows from the
+# file as they're fetched anyway. yield_per tells SQLAlchemy to fetch
+# chunk_size rows at a time instead of buffering the whole result, and
+# partitions() hands them over in chunks of that size. (In 1.4 and later
+# yield_per implies stream_results.)
+
+# stream_rows() is for Expression Language selects and yields Row tuples.
+# stream_objects() is for the ORM and yields Inventory objects. The session
+# only keeps weak references to the objects it loads, so once a chunk has
+# been dealt with and dropped, its objects can be garbage collected. Don't
+# change the objects though: changed objects are kept until the session is
+# flushed, and the session here is closed without committing.
+
+# The connection (and, for objects, the session) stays open until the
+# generator is used up or closed.
+
+def stream_rows(engine, statement=None, chunk_size=1000):
+    if statement is None:
+        statement = inventory.select()
+    with engine.connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=chunk_size).execute(statement)
+        for chunk in result.partitions(chunk_size):
+            yield chunk
+
+
+def stream_objects(engine, statement=None, chunk_size=1000):
+    if statement is None:
+        statement = sa.select(Inventory)
+    with Session(engine) as session:
+        result = session.scalars(
+            statement.execution_options(yield_per=chunk_size))
+        for chunk in result.partitions(chunk_size):
+            yield chunk
+
+
+# Result cache
+# -----------------------------------------------------------------------------
+# A dashboard that runs the same few selects many times a second against
+# data that only changes a few times a minute is mostly asking the database
+# questions it already knows the answer to. QueryCache keeps the rows from
+# recent selects and hands them back without touching the database:
+
+# – The key is the SQL the statement compiles to plus its parameter values,
+#   so inventory.select() and select(inventory).where(...) with different
+#   values are cached separately.
+# – At most size results are kept. An OrderedDict keeps them in order of use
+#   and the least recently used one is dropped first (the same idea as the
+#   identity map in sqlite3_example3.py).
+# – Each result remembers which tables it read. QueryCache listens to the
+#   engine's events, and any INSERT, UPDATE or DELETE on a table that goes
+#   through the engine (Core, ORM session flushes and plain SQL strings
+#   alike) drops every cached result that read that table. For Core and ORM
+#   statements the table comes from the compiled statement, so one with a
+#   CTE (update().add_cte(...)) counts too. Plain SQL is matched as text,
+#   with or without a WITH ... in front of it. Table names are
+#   compared in lower case, with quotes and any schema prefix taken off: INTO
+#   INVENTORY and into "inventory" both count as a change to inventory. At
+#   worst that drops results for a different table whose name differs only
+#   in case, which is only a wasted select.
+# – A select only gets cached if the tables it reads are known, i.e. it's
+#   built from Table objects. A text('SELECT ...') is run every time.
+# – Until the transaction that made the change has finished, nothing read
+#   from the table is stored, since it could be from either side of the
+#   commit. The engine's commit event fires just before the commit, not
+#   after, so "finished" here is when the connection goes back to the pool
+#   (the pool's checkin event). The results are dropped again then. A
+#   connection that's invalidated (closed after an error) or detached from
+#   the pool counts as finished too: the pool forgets what was noted on it
+#   and the table would otherwise never be cached again.
+# – A select that was already running when a table changed might bring back
+#   rows from before the change. Each table has a counter that goes up on
+#   every change, and a result is only stored if the counters of the tables
+#   it read are the same as when it started.
+# – hits and misses count how often the cache did and didn't have the
+#   answer.
+
+# Changes made some other way (another program, another engine, the
+# database's own triggers) aren't seen, so this only suits tables that this
+# engine is the only writer for. Rows are Row objects, which are immutable,
+# and each caller gets their own list.
+
+_WRITE = re.compile(r'''^\s*(?:WITH\b.*?\)\s*)?  # WITH name AS (...), ...
+                        (?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|
+                          UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+
+                        (?:["`\[]?\w+["`\]]?\.)?  # schema.
+                        ["`\[]?(\w+)''',
+                    re.IGNORECASE | re.VERBOSE | re.DOTALL)
+
+
+def _written_table(context, statement):
+    # the (lower case) name of the table a statement changes, or None
+    if context.isinsert or context.isupdate or context.isdelete:
+        table = getattr(context.compiled.statement, 'table', None)
+        if isinstance(table, sa.Table):
+            return table.name.lower()
+    match = _WRITE.match(statement)
+    return match.group(1).lower() if match else None
+
+
+def _freeze(value):
+    # parameter values as something hashable, e.g. the list for an IN (...)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class QueryCache():
+
+    def __init__(self, engine, size=256):
+        self.engine = engine
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()  # key -> (tables, rows)
+        self._keys = collections.defaultdict(set)  # table -> keys
+        self._versions = collections.Counter()     # table -> changes
+        self._writing = collections.Counter()      # table -> transactions
+        self._lock = threading.Lock()
+        self._listeners = [('after_cursor_execute', self._after_execute),
+                           ('checkin', self._checkin),
+                           ('invalidate', self._checkin),
+                           ('detach', self._checkin)]
+        for name, listener in self._listeners:
+            sa.event.listen(engine, name, listener)
+
+    def execute(self, statement):
+        # statement is a Core select, e.g. inventory.select()
+        compiled = statement.compile(dialect=self.engine.dialect)
+        params = compiled.params.items()
+        key = (str(compiled),
+               tuple(sorted((name, _freeze(value)) for name, value in params)))
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return list(self._results[key][1])
+            self.misses += 1
+            tables = frozenset(element.name.lower() for element
+                               in sa.sql.visitors.iterate(statement)
+                               if isinstance(element, sa.Table))
+            versions = [self._versions[table] for table in tables]
+        with self.engine.connect() as conn:
+            rows = conn.execute(statement).all()
+        if not tables:
+            return list(rows)
+        with self._lock:
+            if (versions == [self._versions[table] for table in tables] and
+                    not any(self._writing[table] for table in tables)):
+                self._store(key, tables, rows)
+        return list(rows)
+
+    def _store(self, key, tables, rows):
+        self._results[key] = (tables, rows)
+        for table in tables:
+            self._keys[table].add(key)
+        while len(self._results) > self.size:
+            old, (old_tables, _) = self._results.popitem(last=False)
+            for table in old_tables:
+                self._keys[table].discard(old)
+
+    def invalidate(self, table):
+        table = table.lower()
+        with self._lock:
+            self._versions[table] += 1
+            for key in self._keys.pop(table, ()):
+                self._results.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            for table in list(self._keys):
+                self._versions[table] += 1
+            self._results.clear()
+            self._keys.clear()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        table = _written_table(context, statement)
+        if table:
+            # conn.info belongs to the pooled connection, so _checkin() sees
+            # the same dict
+            changed = conn.info.setdefault('query_cache_changed', set())
+            if table not in changed:
+                changed.add(table)
+                with self._lock:
+                    self._writing[table] += 1
+            self.invalidate(table)
+
+    def _checkin(self, dbapi_connection, connection_record, *exception):
+        # the pool resets (rolls back) a connection before this, so
+        # whatever it changed is either committed or gone by now. Also
+        # called when the connection is invalidated or detached, after
+        # which the pool clears (or stops checking in) connection_record,
+        # so this has to be the last look at it. pop() makes a second call
+        # for the same transaction do nothing.
+        for table in connection_record.info.pop('query_cache_changed', ()):
+            with self._lock:
+                self._writing[table] -= 1
+            self.invalidate(table)
+
+    def close(self):
+        for name, listener in self._listeners:
+            sa.event.remove(self.engine, name, listener)
+        self.clear()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    engine = sa.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+
+    bulk_insert(engine, [('shoe laces', 12, 1.0), ('mascara', 24, 12.0)])
+    upsert(engine, [('mascara', 20, 11.5), ('peanuts', 1200, 6.99)])
+
+    with Session(engine) as session:
+        print(session.scalars(sa.select(Inventory)).all())
+
+    # total value, one chunk of two rows at a time
+    total = 0
+    for chunk in stream_rows(engine, chunk_size=2):
+        total += sum(row.count * row.cost for row in chunk)
+    print(round(total, 2))
+
+    cheap = sa.select(Inventory).where(Inventory.cost < 10)
+    for chunk in stream_objects(engine, cheap, chunk_size=2):
+        print(chunk)
+
+    cache = QueryCache(engine)
+    query = inventory.select().where(inventory.c.count > 20)
+    print(cache.execute(query))
+    print(cache.execute(query))
+    upsert(engine, [('shoe laces', 30, 1.0)])
+    print(cache.execute(query))
+    print('hits: {}, misses: {}'.format(cache.hits, cache.misses))
+    cache.close()
+
+# [<Inventory(shoe laces, 12, 1.0)>, <Inventory(mascara, 20, 11.5)>,
+# <Inventory(peanuts, 1200, 6.99)>]
+# 8630.0
+# [<Inventory(shoe laces, 12, 1.0)>, <Inventory(peanuts, 1200, 6.99)>]
+# [('peanuts', 1200, 6.99)]
+# [('peanuts', 1200, 6.99)]
+# [('shoe laces', 30, 1.0), ('peanuts', 1200, 6.99)]
+# hits: 1, misses: 2
+
+
+# Benchmark: session.add_all() vs bulk inserts
+# -----------------------------------------------------------------------------
+# Each run starts with an empty table in a new in-memory database, so the
+# times are about python and SQLAlchemy rather than the disk.
+# bulk_insert_mappings() is the ORM's own bulk method: it takes dicts,
+# skips the unit of work too and ends up much the same as bulk_insert().
+
+def _rows(size, start=0):
+    return (('thing{}'.format(i), i % 100, i / 100)
+            for i in range(start, start + size))
+
+
+def _add_all(engine, size):
+    with Session(engine) as session:
+        session.add_all([Inventory(*row) for row in _rows(size)])
+        session.commit()
+
+
+def _bulk_insert_mappings(engine, size):
+    with Session(engine) as session:
+        session.bulk_insert_mappings(
+            Inventory, [{'things': things, 'count': count, 'cost': cost}
+                        for things, count, cost in _rows(size)])
+        session.commit()
+
+
+def _bulk_insert(engine, size):
+    bulk_insert(engine, _rows(size))
+
+
+def _upsert_half_existing(engine, size):
+    # half the rows are already there (updated), half are new (inserted)
+    bulk_insert(engine, _rows(size // 2, start=size // 2))
+    start = time.perf_counter()
+    upsert(engine, _rows(size))
+    return time.perf_counter() - start
+
+
+def _timed(run, size):
+    engine = sa.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    start = time.perf_counter()
+    elapsed = run(engine, size)
+    if elapsed is None:
+        elapsed = time.perf_counter() - start
+    with engine.connect() as conn:
+        count = conn.scalar(sa.select(sa.func.count()).select_from(inventory))
+    engine.dispose()
+    return elapsed, count
+
+
+def benchmark(sizes=(10000, 100000, 1000000)):
+    runs = [('session.add_all()', _add_all),
+            ('bulk_insert_mappings()', _bulk_insert_mappings),
+            ('bulk_insert()', _bulk_insert),
+            ('upsert(), half exist', _upsert_half_existing)]
+    print('-' * 50)
+    print('{:<24}'.format('rows') +
+          ''.join('{:>10}'.format(size) for size in sizes))
+    for name, run in runs:
+        times = []
+        for size in sizes:
+            elapsed, count = _timed(run, size)
+            assert count == size, count
+            times.append(elapsed)
+        print('{:<24}'.format(name) +
+              ''.join('{:>9.2f}s'.format(t) for t in times))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+# --------------------------------------------------
+# rows                         10000    100000   1000000
+# session.add_all()            0.64s     8.01s    78.59s
+# bulk_insert_mappings()       0.13s     1.12s    13.40s
+# bulk_insert()                0.07s     0.60s     7.91s
+# upsert(), half exist         0.05s     0.67s     4.99s
+
+# add_all() also has to keep all 1,000,000 Inventory objects in memory until
+# the commit. The upsert only inserts half as many rows as bulk_insert(),
+# which is why it can come out ahead.
+
+
+# Benchmark: fetch everything vs streaming, memory
+# -----------------------------------------------------------------------------
+# Each way of reading adds up the value of the whole table. tracemalloc
+# records the peak memory python allocated while it did.
+
+def _peak(read):
+    tracemalloc.start()
+    total = read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20, total
+
+
+def benchmark_stream(sizes=(100000, 400000), chunk_size: int=1000):
+    def fetchall(engine):
+        with engine.connect() as conn:
+            rows = conn.execute(inventory.select()).fetchall()
+        return sum(row.count * row.cost for row in rows)
+
+    def rows(engine):
+        return sum(row.count * row.cost
+                   for chunk in stream_rows(engine, chunk_size=chunk_size)
+                   for row in chunk)
+
+    def all_objects(engine):
+        with Session(engine) as session:
+            items = session.scalars(sa.select(Inventory)).all()
+            return sum(item.count * item.cost for item in items)
+
+    def objects(engine):
+        return sum(item.count * item.cost
+                   for chunk in stream_objects(engine, chunk_size=chunk_size)
+                   for item in chunk)
+
+    reads = [('fetchall()', fetchall), ('stream_rows()', rows),
+             ('scalars().all()', all_objects),
+             ('stream_objects()', objects)]
+    peaks = {name: [] for name, read in reads}
+    for size in sizes:
+        engine = sa.create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        bulk_insert(engine, _rows(size))
+        totals = set()
+        for name, read in reads:
+            peak, total = _peak(lambda: read(engine))
+            peaks[name].append(peak)
+            totals.add(round(total, 2))
+        assert len(totals) == 1, totals
+        engine.dispose()
+
+    print('-' * 50)
+    print('peak MB, rows:     ' +
+          ''.join('{:>10}'.format(size) for size in sizes))
+    for name, read in reads:
+        print('{:<18}'.format(name) +
+              ''.join('{:>10.1f}'.format(peak) for peak in peaks[name]))
+
+
+if __name__ == '__main__':
+    benchmark_stream()
+
+# --------------------------------------------------
+# peak MB, rows:         100000    400000
+# fetchall()              21.5      86.8
+# stream_rows()            0.3       0.3
+# scalars().all()        105.9     424.4
+# stream_objects()         2.2       2.2
+
+# The streaming versions stay the same size however big the table gets. ORM
+# objects cost about five times as much memory as plain rows.
+
+
+# Benchmark: dashboard queries, engine vs QueryCache
+# -----------------------------------------------------------------------------
+# A pretend dashboard runs three selects over and over against a table of
+# 10,000 rows, and every writes_every queries something changes a row.
+
+def benchmark_cache(queries: int=3000, writes_every: int=300):
+    engine = sa.create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    bulk_insert(engine, _rows(10000))
+    dashboard = [
+        inventory.select().where(inventory.c.cost < 1),
+        sa.select(sa.func.sum(inventory.c.count * inventory.c.cost)),
+        inventory.select().order_by(inventory.c.count.desc()).limit(10)]
+    change = (inventory.update().where(inventory.c.things == 'thing0')
+              .values(count=inventory.c.count + 1))
+
+    def run(read):
+        start = time.perf_counter()
+        for i in range(queries):
+            if i % writes_every == 0:
+                with engine.begin() as conn:
+                    conn.execute(change)
+            read(dashboard[i % len(dashboard)])
+        return queries / (time.perf_counter() - start)
+
+    def direct(statement):
+        with engine.connect() as conn:
+            return conn.execute(statement).all()
+
+    cache = QueryCache(engine)
+    results = [run(direct), run(cache.execute)]
+    cache.close()
+    engine.dispose()
+
+    print('-' * 50)
+    print('engine:      {:>8.0f} queries/sec'.format(results[0]))
+    print('QueryCache:  {:>8.0f} queries/sec ({} hits, {} misses)'.format(
+        results[1], cache.hits, cache.misses))
+
+
+if __name__ == '__main__':
+    benchmark_cache()
+
+# --------------------------------------------------
+# engine:          1241 queries/sec
+# QueryCache:      8206 queries/sec (2970 hits, 30 misses)
+
+# Most of the time left on a hit goes on compiling the statement to get its
+# key.
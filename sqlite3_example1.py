@@ -10,6 +10,10 @@ import sqlite3
 import datetime
 import pytz
 
+# NOTE: this one module-global connection is shared by everything below, so
+# it can't safely be used from several threads, and readers wait while a
+# writer commits. See sqlite3_example3.py for a per-thread connection pool
+# with WAL.
 db = sqlite3.connect('data/accounts1.sqlite')
 db.execute('''CREATE TABLE IF NOT EXISTS accounts
               (name TEXT PRIMARY KEY NOT NULL,
@@ -25,6 +29,11 @@ db.execute('''CREATE TABLE IF NOT EXISTS history
 # uniquely identify each transaction but together they work.
 
 
+# NOTE: every Account(name) below runs a SELECT (and an INSERT + commit for a
+# new account). See sqlite3_example3.py for an identity map that serves
+# repeated lookups from memory.
+
+
 class Account():
 
     @staticmethod
@@ -8,11 +8,23 @@
 # displayed later. This whole thing is probably overkill for most situations
 # but may prove useful as an example sometime.
 
+# Pickling the time zone into every history row turned out to be wasteful:
+# each row carries a ~100 byte blob that's almost always the same, every
+# update pays for pickle.dumps() and every read for pickle.loads(). Instead,
+# each distinct time zone is pickled once into a small timezones table and
+# history just stores its integer id (interning). A dictionary on each side
+# remembers the ids and tzinfo objects we've already seen, so after the first
+# update nothing gets pickled or unpickled at all.
+
 import sqlite3
 import datetime
 import pytz
 import pickle  # <-- added
 
+# NOTE: this one module-global connection is shared by everything below, so
+# it can't safely be used from several threads, and readers wait while a
+# writer commits. See sqlite3_example3.py for a per-thread connection pool
+# with WAL.
 db = sqlite3.connect('data/accounts2.sqlite')
 db.execute('''CREATE TABLE IF NOT EXISTS accounts
               (name TEXT PRIMARY KEY NOT NULL,
@@ -24,6 +36,65 @@ db.execute('''CREATE TABLE IF NOT EXISTS history
               amount INTEGER NOT NULL,
               timezone INTEGER NOT NULL,
               PRIMARY KEY (time, account))''')
+# the timezone column holds an id from this table:
+db.execute('''CREATE TABLE IF NOT EXISTS timezones
+              (id INTEGER PRIMARY KEY,
+              pickled BLOB UNIQUE NOT NULL)''')
+
+# Older versions of this example put the pickled blob straight into history.
+# Move any of those into the timezones table and swap them for their ids:
+db.execute('''INSERT OR IGNORE INTO timezones (pickled)
+              SELECT DISTINCT timezone FROM history
+              WHERE typeof(timezone) = 'blob' ''')
+db.execute('''UPDATE history
+              SET timezone = (SELECT id FROM timezones
+                              WHERE pickled = history.timezone)
+              WHERE typeof(timezone) = 'blob' ''')
+db.commit()
+
+
+# Interned time zones
+# -----------------------------------------------------------------------------
+# _timezone_ids maps a time zone -> id for writing, _timezones maps
+# id -> tzinfo for reading. The tzinfo itself can't be the key: two
+# datetime.timezone objects are equal if their offsets are, whatever their
+# names, so timezone(timedelta(hours=-7), 'PDT') == timezone(timedelta(
+# hours=-7), 'MST') and MST would get PDT's id. The key is the offset and the
+# name instead. (The pickled blob in the table has both in it, so the UNIQUE
+# lookup already tells them apart.)
+
+_timezone_ids = {}
+_timezones = {}
+
+
+def timezone_id(timezone):
+    key = (timezone.utcoffset(None), timezone.tzname(None))
+    tz_id = _timezone_ids.get(key)
+    if tz_id is None:
+        pickled = pickle.dumps(timezone)
+        db.execute("INSERT OR IGNORE INTO timezones (pickled) VALUES(?)",
+                   (pickled,))
+        db.commit()  # only ever happens once per time zone
+        tz_id = db.execute("SELECT id FROM timezones WHERE pickled = ?",
+                           (pickled,)).fetchone()[0]
+        _timezone_ids[key] = tz_id
+        _timezones[tz_id] = timezone
+    return tz_id
+
+
+def timezone_from_id(conn, tz_id):
+    timezone = _timezones.get(tz_id)
+    if timezone is None:
+        pickled = conn.execute("SELECT pickled FROM timezones WHERE id = ?",
+                               (tz_id,)).fetchone()[0]
+        timezone = pickle.loads(pickled)
+        _timezones[tz_id] = timezone
+    return timezone
+
+
+# NOTE: every Account(name) below runs a SELECT (and an INSERT + commit for a
+# new account). See sqlite3_example3.py for an identity map that serves
+# repeated lookups from memory.
 
 
 class Account():
@@ -55,13 +126,13 @@ class Account():
     def _save_update(self, amount):
         new_balance = self._balance + amount
         time, timezone = Account._current_time()  # <-- unpack the tuple
-        pickled_timezone = pickle.dumps(timezone)  # <-- pickle the time zone
         try:
+            tz_id = timezone_id(timezone)  # <-- look up the time zone's id
             db.execute("UPDATE accounts SET balance = ? WHERE name = ?",
                        (new_balance, self.name))
-            # add the pickled_timezone to the update:
+            # add the time zone id to the update:
             db.execute("INSERT INTO history VALUES(?, ?, ?, ?)",
-                       (time, self.name, amount, pickled_timezone))
+                       (time, self.name, amount, tz_id))
         except sqlite3.Error:
             db.rollback()
         else:
@@ -108,13 +179,14 @@ print('-' * 75)
 
 # Get the pickled timezone
 # -----------------------------------------------------------------------------
+# Each row has a time zone id. timezone_from_id() only unpickles the first
+# time it sees an id; after that it's a dictionary lookup.
 
 db = sqlite3.connect('data/accounts2.sqlite', detect_types=sqlite3.PARSE_DECLTYPES)
 
 for row in db.execute("SELECT * FROM history"):
     utc_time = row[0]
-    pickled_timezone = row[3]
-    timezone = pickle.loads(pickled_timezone)
+    timezone = timezone_from_id(db, row[3])
     local_time = pytz.utc.localize(utc_time).astimezone(timezone)
     print("{}\t{}\t{}".format(utc_time, local_time, local_time.tzinfo))
 